@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from typing import Callable, Dict, Any, Optional, Tuple
+
+# Для бенчмарка боту не нужны настоящие ключи, но main.py читает их при импорте
+os.environ.setdefault('BOT_API_KEY', '123456:bench')
+os.environ.setdefault('USER_ID', '0')
+os.environ.setdefault('TELEGRAM_API_ID', '0')
+os.environ.setdefault('TELEGRAM_API_HASH', 'bench')
+
+import main
+from main import (I, FONT_PATH, CITY_BOX, TIME_BOX, TEMP_BOX, TIME_FONT_SIZE, CLOCK_ANCHOR, WEATHER_ANCHOR,
+                  ENCODERS, draw_scaled_text, draw_clock, generate_icon, place_overlay_on_base,
+                  font_registry, text_fit_cache, glyph_atlas, clock_atlas, layered_renderer)
+
+TEXTS = {
+    "latin_short": "Moscow",
+    "latin_long": "Good morning from the coldest and most beautiful city on the Volga river",
+    "cyrillic_short": "Москва",
+    "cyrillic_long": "Доброе утро из самого холодного и самого красивого города на берегу Волги",
+}
+
+FRAME = ("Доброе утро из Казани", "14:35", "+12", "CLOUD")
+
+
+def reset_caches():
+    font_registry.layouts.clear()
+    text_fit_cache.entries.clear()
+    glyph_atlas.glyphs.clear()
+    glyph_atlas.strings.clear()
+    glyph_atlas.verified.clear()
+    clock_atlas.faces.clear()
+    layered_renderer.static_layers.clear()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def measure(func: Callable[[], Any], iterations: int, setup: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    samples = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    # Память меряется отдельным прогоном: tracemalloc заметно замедляет код и искажал бы время
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "mean_ms": sum(samples) / len(samples),
+        "min_ms": min(samples),
+        "p50_ms": percentile(samples, 50),
+        "p90_ms": percentile(samples, 90),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples),
+        "peak_memory_kb": peak / 1024,
+        # Для кодировщиков — размер результата
+        **({"bytes": len(result)} if isinstance(result, bytes) else {}),
+    }
+
+
+# Случай: (измеряемая функция, подготовка перед каждым повтором)
+Case = Tuple[Callable[[], Any], Optional[Callable[[], None]]]
+
+
+def bench_text() -> Dict[str, Case]:
+    cases = {}
+    base = I["TEMPLATE"].copy()
+
+    for name, text in TEXTS.items():
+        def search(text=text):
+            draw_scaled_text(base, text, CITY_BOX, FONT_PATH)
+        cases[f"draw_scaled_text/search/{name}/cold"] = (search, reset_caches)
+        cases[f"draw_scaled_text/search/{name}/warm"] = (search, None)
+
+    for name, text in (("time", "14:35"), ("temp", "+12")):
+        def fixed(text=text, box=TIME_BOX if name == "time" else TEMP_BOX):
+            draw_scaled_text(base, text, box, FONT_PATH, size_fonts=TIME_FONT_SIZE)
+        cases[f"draw_scaled_text/fixed/{name}/cold"] = (fixed, reset_caches)
+        cases[f"draw_scaled_text/fixed/{name}/warm"] = (fixed, None)
+
+    return cases
+
+
+def all_clock_positions() -> list[str]:
+    return [f"{hours:02d}:{minutes:02d}" for hours in range(12) for minutes in range(0, 60, 5)]
+
+
+def bench_clock() -> Dict[str, Case]:
+    positions = all_clock_positions()
+
+    def rotate_all():
+        for time_str in positions:
+            draw_clock(I["CLOCK"].copy(), I["HOUR_HAND"], I["MINUTE_HAND"], time_str)
+
+    def atlas_all():
+        for time_str in positions:
+            clock_atlas.get(time_str)
+
+    return {
+        "draw_clock/144_positions": (rotate_all, None),
+        "clock_atlas/144_positions/cold": (atlas_all, clock_atlas.faces.clear),
+        "clock_atlas/144_positions/warm": (atlas_all, None),
+    }
+
+
+def bench_frame() -> Dict[str, Case]:
+    cases = {
+        "generate_icon/cold": (lambda: generate_icon(*FRAME), reset_caches),
+        "generate_icon/warm": (lambda: generate_icon(*FRAME), None),
+    }
+
+    # Кадр для кодировщиков рисуется только если выбран хотя бы один из них
+    frames = {}
+
+    def icon():
+        if "icon" not in frames:
+            frames["icon"] = generate_icon(*FRAME)
+        return frames["icon"]
+
+    for mode, (encoder, _) in ENCODERS.items():
+        cases[f"encode/{mode}"] = (lambda encoder=encoder: encoder(icon()), icon)
+    return cases
+
+
+def bench_phases(iterations: int) -> Dict[str, Any]:
+    # Разбивка кадра по этапам в том же порядке, что и в LayeredRenderer.render
+    city, time_str, temp, weather = FRAME
+    phases: Dict[str, list[float]] = {}
+
+    def timed(name: str, func: Callable[[], Any]) -> Any:
+        started = time.perf_counter()
+        result = func()
+        phases.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+        return result
+
+    for _ in range(iterations):
+        reset_caches()
+        timed("static_layer", lambda: layered_renderer.get_static_layer(city))
+        base = timed("copy", lambda: layered_renderer.get_static_layer(city).copy())
+        timed("time_text", lambda: draw_scaled_text(base, time_str, TIME_BOX, FONT_PATH, size_fonts=TIME_FONT_SIZE))
+        timed("temp_text", lambda: draw_scaled_text(base, temp, TEMP_BOX, FONT_PATH, size_fonts=TIME_FONT_SIZE))
+        face = timed("clock_face", lambda: clock_atlas.get(time_str))
+        timed("clock_paste", lambda: place_overlay_on_base(base, face, *CLOCK_ANCHOR))
+        timed("weather_icon", lambda: place_overlay_on_base(base, I[weather], *WEATHER_ANCHOR))
+        timed("encode", lambda: main.encode_icon(base))
+
+    return {name: {"mean_ms": sum(samples) / len(samples), "p50_ms": percentile(samples, 50)}
+            for name, samples in phases.items()}
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> list[str]:
+    regressions = []
+    for name, current in results["cases"].items():
+        previous = baseline.get("cases", {}).get(name)
+        if not previous:
+            continue
+        ratio = current["p50_ms"] / previous["p50_ms"] if previous["p50_ms"] else 1.0
+        current["baseline_p50_ms"] = previous["p50_ms"]
+        current["ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name}: {previous['p50_ms']:.2f} -> {current['p50_ms']:.2f} мс (x{ratio:.2f})")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера аватара")
+    parser.add_argument("--iterations", type=int, default=20, help="повторов на каждый случай")
+    parser.add_argument("--only", default="",
+                        help="запускать только случаи, содержащие подстроку (разбивка по этапам — случай phases)")
+    parser.add_argument("--output", help="куда сохранить JSON с результатами")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="допустимое замедление p50, доля")
+    args = parser.parse_args()
+
+    for img in I.values():
+        img.load()
+
+    cases = {}
+    for suite in (bench_text, bench_clock, bench_frame):
+        for name, (func, setup) in suite().items():
+            if args.only in name:
+                cases[name] = measure(func, args.iterations, setup=setup)
+
+    results = {
+        "python": sys.version.split()[0],
+        "encoder": main.AVATAR_ENCODER,
+        "output_size": I["TEMPLATE"].width,
+        "cases": cases,
+    }
+    if args.only in "phases":
+        results["phases"] = bench_phases(args.iterations)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
+
+    if regressions:
+        print("Замедления относительно базового прогона:", file=sys.stderr)
+        for line in regressions:
+            print(f"  {line}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -3,11 +3,23 @@ import asyncio
 import logging
 import io
 import re
+import random
+import math
+import mmap
+import hashlib
+import json
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
 from datetime import datetime, timezone, timedelta, time
 from typing import Optional, Tuple, Callable, Dict, Any, Awaitable
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 
 import aiohttp
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -17,20 +29,26 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import BaseMiddleware
 from dotenv import load_dotenv
 from telethon import TelegramClient
-from telethon.tl.functions.photos import UploadProfilePhotoRequest, DeletePhotosRequest
+from telethon.tl.functions.photos import UploadProfilePhotoRequest, DeletePhotosRequest, GetUserPhotosRequest
+from telethon.tl.functions.upload import SaveFilePartRequest, SaveBigFilePartRequest
 from telethon.errors import FloodWaitError
-from telethon.tl.types import InputPhoto
-from PIL import Image, ImageDraw, ImageFont
+from telethon.tl.types import InputPhoto, InputUserSelf, InputFile, InputFileBig
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageStat
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_API_KEY')
-USER_ID = int(os.getenv('USER_ID'))
+USER_ID = int(os.getenv('USER_ID')) if os.getenv('USER_ID') else None  # Обязателен без ACCOUNTS_FILE
 OPENWEATHER_API_KEY = os.getenv('OPENWEATHERMAP_API_KEY')
 TELEGRAM_API_ID = int(os.getenv("TELEGRAM_API_ID"))
 TELEGRAM_API_HASH = os.getenv("TELEGRAM_API_HASH")
 SESSION_NAME = 'profile_changer'
-FIXED_INTERVAL = 5  # Фиксированный интервал 5 минут
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE")  # JSON со списком аккаунтов для многопрофильного режима
+FIXED_INTERVAL = int(os.getenv("UPDATE_INTERVAL", "5"))  # Интервал обновления в минутах
+SCHEDULER_LEAD = float(os.getenv("SCHEDULER_LEAD", "0"))  # Запас в секундах до границы интервала
+GOVERNOR_MAX_MULTIPLIER = int(os.getenv("GOVERNOR_MAX_MULTIPLIER", "3"))  # 5 → 10 → 15 минут
+GOVERNOR_QUIET_PERIOD = int(os.getenv("GOVERNOR_QUIET_PERIOD", "3600"))  # Секунд без flood-wait до снижения интервала
+UPLOADS_PER_HOUR = int(os.getenv("UPLOADS_PER_HOUR", "20"))  # 0 или меньше — без ограничения
 
 logging.basicConfig(
     level=logging.INFO,
@@ -53,8 +71,264 @@ CITY_BOX = (172, 285, 1108, 615)
 C_BOX = (1080, 706, 1180, 796)
 TIME_BOX = (250, 670, 625, 865)
 TEMP_BOX = (835, 670, 1095, 865)
+CLOCK_ANCHOR = (170, 772)
+WEATHER_ANCHOR = (755, 772)
+TIME_FONT_SIZE = 160
 
-I = {img: Image.open(f"images/{img.lower()}.png") for img in IMGS}
+OUTPUT_SIZE = int(os.getenv("OUTPUT_SIZE", "0"))  # Сторона итогового аватара в пикселях; 0 — размер шаблона
+
+ASSET_PACK = os.getenv("ASSET_PACK")  # Путь к бинарному пакету ассетов; не задан — грузим PNG напрямую
+ASSET_PACK_MAGIC = b"DPTASSET1"
+
+
+def asset_paths() -> Dict[str, str]:
+    return {img: f"images/{img.lower()}.png" for img in IMGS}
+
+
+def check_assets():
+    missing = [path for path in list(asset_paths().values()) + [FONT_PATH] if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Не найдены файлы ресурсов: {', '.join(missing)}")
+    try:
+        ImageFont.truetype(FONT_PATH, 10)
+    except OSError as e:
+        raise OSError(f"Не удалось открыть шрифт {FONT_PATH}: {e}") from e
+
+
+def assets_hash() -> str:
+    digest = hashlib.sha256()
+    for path in asset_paths().values():
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load_png_assets() -> Dict[str, Image.Image]:
+    images = {}
+    for img, path in asset_paths().items():
+        with Image.open(path) as source:
+            images[img] = source.convert("RGBA")
+    return images
+
+
+def build_asset_pack(path: str):
+    # Формат: сигнатура, длина заголовка (4 байта), JSON-заголовок, затем сырые RGBA-буферы
+    images = load_png_assets()
+    entries = {}
+    offset = 0
+    for img, image in images.items():
+        length = image.width * image.height * 4
+        entries[img] = {'size': [image.width, image.height], 'offset': offset, 'length': length}
+        offset += length
+    header = json.dumps({'hash': assets_hash(), 'images': entries}).encode()
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ASSET_PACK_MAGIC)
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        for image in images.values():
+            f.write(image.tobytes("raw", "RGBA"))
+    os.replace(tmp_path, path)
+    logger.info(f"Пакет ассетов собран: {path}")
+
+
+def load_asset_pack(path: str) -> Optional[Dict[str, Image.Image]]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(ASSET_PACK_MAGIC)] != ASSET_PACK_MAGIC:
+        return None
+    header_start = len(ASSET_PACK_MAGIC) + 4
+    header_length = int.from_bytes(mapped[len(ASSET_PACK_MAGIC):header_start], "little")
+    header = json.loads(mapped[header_start:header_start + header_length])
+    if header['hash'] != assets_hash() or set(header['images']) != set(IMGS):
+        return None
+
+    # Изображения ссылаются прямо на отображенную память, без копирования;
+    # страницы файла делятся между всеми процессами пула рендера
+    data_start = header_start + header_length
+    view = memoryview(mapped)
+    images = {}
+    for img, entry in header['images'].items():
+        start = data_start + entry['offset']
+        images[img] = Image.frombuffer("RGBA", tuple(entry['size']), view[start:start + entry['length']],
+                                       "raw", "RGBA", 0, 1)
+    return images
+
+
+def load_assets() -> Dict[str, Image.Image]:
+    check_assets()
+    if ASSET_PACK:
+        images = load_asset_pack(ASSET_PACK)
+        if images is None:
+            build_asset_pack(ASSET_PACK)
+            images = load_asset_pack(ASSET_PACK)
+        if images is not None:
+            return images
+        logger.warning(f"Пакет ассетов {ASSET_PACK} не читается, загружаю PNG")
+    return load_png_assets()
+
+
+def scaled_size(size: Tuple[int, int], scale: float) -> Tuple[int, int]:
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def scale_assets(images: Dict[str, Image.Image], scale: float) -> Dict[str, Image.Image]:
+    if scale == 1:
+        return images
+    return {img: image.resize(scaled_size(image.size, scale), Image.LANCZOS) for img, image in images.items()}
+
+
+SOURCE_IMAGES = load_assets()
+
+# Кадр собирается сразу в выходном разрешении: шаблон, спрайты, координаты и кегль масштабируются один раз
+RENDER_SCALE = OUTPUT_SIZE / SOURCE_IMAGES["TEMPLATE"].width if OUTPUT_SIZE > 0 else 1.0
+if RENDER_SCALE != 1:
+    CITY_BOX, C_BOX, TIME_BOX, TEMP_BOX = (tuple(round(v * RENDER_SCALE) for v in box)
+                                           for box in (CITY_BOX, C_BOX, TIME_BOX, TEMP_BOX))
+    CLOCK_ANCHOR, WEATHER_ANCHOR = (tuple(round(v * RENDER_SCALE) for v in point)
+                                    for point in (CLOCK_ANCHOR, WEATHER_ANCHOR))
+    TIME_FONT_SIZE = max(1, round(TIME_FONT_SIZE * RENDER_SCALE))
+    logger.info(f"Рендер в разрешении {OUTPUT_SIZE}px (масштаб {RENDER_SCALE:.3f})")
+
+I = scale_assets(SOURCE_IMAGES, RENDER_SCALE)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — эндпоинт метрик выключен
+
+
+class Metrics:
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, prefix: str = "dynamic_profile"):
+        self.prefix = prefix
+        self.counters: defaultdict[Tuple[str, tuple], float] = defaultdict(float)
+        self.histograms: Dict[Tuple[str, tuple], list] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def value(self, name: str, **labels) -> float:
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # [счетчики по корзинам, количество, сумма]
+            histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram[0][index] += 1
+        histogram[1] += 1
+        histogram[2] += seconds
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    @staticmethod
+    def format_labels(labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{self.prefix}_{name}_total{self.format_labels(labels)} {value}")
+        for (name, labels), (buckets, count, total) in sorted(self.histograms.items()):
+            metric = f"{self.prefix}_{name}_seconds"
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                lines.append(f"{metric}_bucket{self.format_labels(labels, (('le', bound),))} {bucket}")
+            lines.append(f"{metric}_bucket{self.format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{metric}_count{self.format_labels(labels)} {count}")
+            lines.append(f"{metric}_sum{self.format_labels(labels)} {total}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, **labels) -> str:
+        label_items = set(labels.items())
+        phases = []
+        for (name, labels_key), (_, count, total) in sorted(self.histograms.items()):
+            if count and label_items <= set(labels_key):
+                phases.append(f"{name} {total / count:.2f} с")
+        counters = defaultdict(float)
+        for (name, labels_key), value in self.counters.items():
+            if label_items <= set(labels_key):
+                counters[name] += value
+        parts = phases + [f"{name}: {int(value)}" for name, value in sorted(counters.items())]
+        return ", ".join(parts) if parts else "данных пока нет"
+
+
+metrics = Metrics()
+
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    if not METRICS_PORT:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+
+BACKENDS = os.getenv("BACKENDS", "live")  # live | fake
+TIME_ACCELERATION = float(os.getenv("TIME_ACCELERATION", "1"))
+FAKE_LATENCY = float(os.getenv("FAKE_LATENCY", "0.3"))  # Секунды модельного времени
+FAKE_FAILURE_RATE = float(os.getenv("FAKE_FAILURE_RATE", "0"))
+FAKE_FLOOD_RATE = float(os.getenv("FAKE_FLOOD_RATE", "0"))
+FAKE_FLOOD_SECONDS = int(os.getenv("FAKE_FLOOD_SECONDS", "300"))
+
+
+class SimClock:
+    # При factor > 1 модельное время идет быстрее реального, а ожидания сокращаются пропорционально
+    def __init__(self, factor: float = 1.0):
+        self.factor = factor
+        self.real_origin = datetime.now()
+        self.sim_origin = self.real_origin
+
+    def now(self) -> datetime:
+        if self.factor == 1:
+            return datetime.now()
+        return self.sim_origin + (datetime.now() - self.real_origin) * self.factor
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(max(seconds, 0) / self.factor)
+
+    async def wait_event(self, event: asyncio.Event, timeout: float):
+        await asyncio.wait_for(event.wait(), max(timeout, 0) / self.factor)
+
+
+clock = SimClock(TIME_ACCELERATION)
+
+
+class FaultInjector:
+    def __init__(self, latency: float, failure_rate: float, flood_rate: float = 0, flood_seconds: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+
+    async def __call__(self):
+        await clock.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.flood_rate:
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        if random.random() < self.failure_rate:
+            raise ConnectionError("Симулированный сбой")
 
 
 class SharedData:
@@ -64,10 +338,27 @@ class SharedData:
         self.profile_text: Optional[str] = None
         self.lat: Optional[float] = None
         self.lon: Optional[float] = None
+        self.settings_updated_at: Optional[datetime] = None  # Когда надпись и город последний раз меняли через /set
+        self.preset_hash: Optional[str] = None  # Хэш надписи и города этого аккаунта из ACCOUNTS_FILE
         self.last_flood_wait: Optional[float] = None
         self.flood_wait_until: Optional[datetime] = None
         self.running = True
         self.last_update_time: Optional[datetime] = None
+        self.last_inputs_fingerprint: Optional[str] = None
+        self.last_pixels_fingerprint: Optional[str] = None
+        self.skipped_uploads = 0
+        self.flood_history: deque[Tuple[datetime, float]] = deque(maxlen=50)
+        self.interval_multiplier = 1
+        self.interval_changed_at: Optional[datetime] = None
+        self.upload_times: deque[datetime] = deque()
+        self.gallery_current: Optional[InputPhoto] = None
+        self.gallery_pending: list[InputPhoto] = []
+        self.changed = asyncio.Event()
+        self.on_change: Optional[Callable[[], None]] = None
+
+    def mark_dirty(self):
+        if self.on_change is not None:
+            self.on_change()
 
     def is_running(self) -> bool:
         return self.running
@@ -78,6 +369,9 @@ class SharedData:
             self.profile_text = profile_text
             self.lat = lat
             self.lon = lon
+            self.settings_updated_at = datetime.now()
+            self.mark_dirty()
+        self.changed.set()
 
     async def get(self) -> Tuple[Optional[str], Optional[str], Optional[float], Optional[float]]:
         async with self.lock:
@@ -85,8 +379,48 @@ class SharedData:
 
     async def set_flood_wait(self, seconds: float):
         async with self.lock:
+            now = clock.now()
             self.last_flood_wait = seconds
-            self.flood_wait_until = datetime.now() + timedelta(seconds=seconds)
+            self.flood_wait_until = now + timedelta(seconds=seconds)
+            self.flood_history.append((now, seconds))
+            if self.interval_multiplier < GOVERNOR_MAX_MULTIPLIER:
+                self.interval_multiplier += 1
+                logger.warning(f"Интервал обновления увеличен до {FIXED_INTERVAL * self.interval_multiplier} мин")
+            self.interval_changed_at = now
+            self.mark_dirty()
+
+    async def get_effective_interval(self) -> int:
+        async with self.lock:
+            now = clock.now()
+            if (self.interval_multiplier > 1 and self.interval_changed_at is not None
+                    and (now - self.interval_changed_at).total_seconds() >= GOVERNOR_QUIET_PERIOD):
+                self.interval_multiplier -= 1
+                self.interval_changed_at = now
+                logger.info(f"Интервал обновления снижен до {FIXED_INTERVAL * self.interval_multiplier} мин")
+                self.mark_dirty()
+            return FIXED_INTERVAL * self.interval_multiplier
+
+    def _trim_uploads(self, now: datetime):
+        while self.upload_times and (now - self.upload_times[0]).total_seconds() >= 3600:
+            self.upload_times.popleft()
+
+    async def record_upload(self):
+        async with self.lock:
+            now = clock.now()
+            self._trim_uploads(now)
+            self.upload_times.append(now)
+            self.mark_dirty()
+
+    async def get_upload_budget(self) -> Tuple[Optional[int], Optional[datetime]]:
+        # Остаток загрузок в скользящем часе и момент, когда освободится следующая; None — лимита нет
+        if UPLOADS_PER_HOUR <= 0:
+            return None, None
+        async with self.lock:
+            now = clock.now()
+            self._trim_uploads(now)
+            remaining = max(UPLOADS_PER_HOUR - len(self.upload_times), 0)
+            next_slot = self.upload_times[0] + timedelta(hours=1) if self.upload_times else None
+            return remaining, next_slot
 
     async def get_flood_info(self) -> Tuple[Optional[float], Optional[datetime]]:
         async with self.lock:
@@ -95,17 +429,225 @@ class SharedData:
     async def stop(self):
         async with self.lock:
             self.running = False
+        self.changed.set()
 
-    async def update_last_time(self):
+    async def update_last_time(self, moment: Optional[datetime] = None):
         async with self.lock:
-            self.last_update_time = datetime.now()
+            self.last_update_time = moment or clock.now()
+            self.mark_dirty()
 
     async def get_last_time(self) -> Optional[datetime]:
         async with self.lock:
             return self.last_update_time
 
+    async def is_duplicate_frame(self, inputs_fingerprint: str, pixels_fingerprint: Optional[str] = None) -> bool:
+        async with self.lock:
+            if inputs_fingerprint == self.last_inputs_fingerprint:
+                return True
+            return pixels_fingerprint is not None and pixels_fingerprint == self.last_pixels_fingerprint
+
+    async def set_frame_fingerprint(self, inputs_fingerprint: str, pixels_fingerprint: str):
+        async with self.lock:
+            self.last_inputs_fingerprint = inputs_fingerprint
+            self.last_pixels_fingerprint = pixels_fingerprint
+            self.mark_dirty()
+
+    async def count_skipped_upload(self):
+        async with self.lock:
+            self.skipped_uploads += 1
+            self.mark_dirty()
+
+    async def get_skipped_uploads(self) -> int:
+        async with self.lock:
+            return self.skipped_uploads
+
+    async def snapshot(self) -> Dict[str, Any]:
+        def when(moment: Optional[datetime]) -> Optional[str]:
+            return moment.isoformat() if moment else None
 
-shared_data = SharedData()
+        def photo(item: InputPhoto) -> Dict[str, Any]:
+            return {'id': item.id, 'access_hash': item.access_hash, 'file_reference': item.file_reference.hex()}
+
+        async with self.lock:
+            return {
+                'city_name': self.city_name,
+                'profile_text': self.profile_text,
+                'lat': self.lat,
+                'lon': self.lon,
+                'settings_updated_at': when(self.settings_updated_at),
+                'preset_hash': self.preset_hash,
+                'last_update_time': when(self.last_update_time),
+                'last_flood_wait': self.last_flood_wait,
+                'flood_wait_until': when(self.flood_wait_until),
+                'flood_history': [(when(moment), seconds) for moment, seconds in self.flood_history],
+                'interval_multiplier': self.interval_multiplier,
+                'interval_changed_at': when(self.interval_changed_at),
+                'upload_times': [when(moment) for moment in self.upload_times],
+                'last_inputs_fingerprint': self.last_inputs_fingerprint,
+                'last_pixels_fingerprint': self.last_pixels_fingerprint,
+                'skipped_uploads': self.skipped_uploads,
+                'gallery_current': photo(self.gallery_current) if self.gallery_current else None,
+                'gallery_pending': [photo(item) for item in self.gallery_pending],
+            }
+
+    def restore(self, state: Dict[str, Any]):
+        def when(value: Optional[str]) -> Optional[datetime]:
+            return datetime.fromisoformat(value) if value else None
+
+        def photo(item: Dict[str, Any]) -> InputPhoto:
+            return InputPhoto(id=item['id'], access_hash=item['access_hash'],
+                              file_reference=bytes.fromhex(item['file_reference']))
+
+        # Надпись и город из состояния побеждают файл аккаунтов, только если их меняли через /set
+        # и запись этого аккаунта в файле с тех пор не менялась; без настроек в конфиге берется сохраненное
+        settings_updated_at = when(state.get('settings_updated_at'))
+        if state.get('profile_text') is not None:
+            if self.profile_text is None:
+                use_saved = True
+            else:
+                use_saved = settings_updated_at is not None and state.get('preset_hash') == self.preset_hash
+
+            if use_saved:
+                if self.profile_text is not None:
+                    logger.info(f"Надпись и город заданы через /set {settings_updated_at:%Y-%m-%d %H:%M}, "
+                                f"значения из файла аккаунтов не используются")
+                self.city_name = state['city_name']
+                self.profile_text = state['profile_text']
+                self.lat = state['lat']
+                self.lon = state['lon']
+                self.settings_updated_at = settings_updated_at
+            elif settings_updated_at is not None:
+                logger.info("Запись аккаунта в файле аккаунтов изменилась после /set, надпись и город берутся из нее")
+        self.last_update_time = when(state.get('last_update_time'))
+        self.last_flood_wait = state.get('last_flood_wait')
+        self.flood_wait_until = when(state.get('flood_wait_until'))
+        self.flood_history.extend((when(moment), seconds) for moment, seconds in state.get('flood_history', []))
+        self.interval_multiplier = state.get('interval_multiplier', 1)
+        self.interval_changed_at = when(state.get('interval_changed_at'))
+        self.upload_times.extend(when(moment) for moment in state.get('upload_times', []))
+        self.last_inputs_fingerprint = state.get('last_inputs_fingerprint')
+        self.last_pixels_fingerprint = state.get('last_pixels_fingerprint')
+        self.skipped_uploads = state.get('skipped_uploads', 0)
+        if state.get('gallery_current'):
+            self.gallery_current = photo(state['gallery_current'])
+        self.gallery_pending = [photo(item) for item in state.get('gallery_pending', [])]
+
+
+class Profile:
+    def __init__(self, name: str, session_name: str, owner_id: int):
+        self.name = name
+        self.session_name = session_name
+        self.owner_id = owner_id
+        self.data = SharedData()
+
+
+def state_file_name(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", name) + ".json"
+
+
+def load_profiles() -> Dict[int, Profile]:
+    if not ACCOUNTS_FILE:
+        if USER_ID is None:
+            raise ValueError("Не задан USER_ID: без ACCOUNTS_FILE бот управляет аккаунтом этого пользователя")
+        return {USER_ID: Profile(SESSION_NAME, SESSION_NAME, USER_ID)}
+
+    with open(ACCOUNTS_FILE, encoding="utf-8") as f:
+        accounts = json.load(f)
+
+    profiles = {}
+    sessions = set()
+    names = set()
+    for account in accounts:
+        profile = Profile(account['name'], account.get('session', account['name']), int(account['user_id']))
+        # Бот управляет одним аккаунтом на владельца, а имя и сессия задают файлы состояния и Telethon —
+        # повтор молча отключил бы один из аккаунтов
+        if profile.owner_id in profiles:
+            raise ValueError(f"{ACCOUNTS_FILE}: user_id {profile.owner_id} указан у нескольких аккаунтов "
+                             f"({profiles[profile.owner_id].name}, {profile.name})")
+        # Сравниваем имена файлов состояния: shop/1 и shop_1 дали бы один и тот же файл
+        if state_file_name(profile.name) in names:
+            raise ValueError(f"{ACCOUNTS_FILE}: имя аккаунта {profile.name} повторяется "
+                             f"или совпадает с другим после замены недопустимых символов")
+        if profile.session_name in sessions:
+            raise ValueError(f"{ACCOUNTS_FILE}: сессия {profile.session_name} указана у нескольких аккаунтов")
+        names.add(state_file_name(profile.name))
+        sessions.add(profile.session_name)
+        if None not in (account.get('city_name'), account.get('text'), account.get('lat'), account.get('lon')):
+            profile.data.city_name = account['city_name']
+            profile.data.profile_text = account['text']
+            profile.data.lat = float(account['lat'])
+            profile.data.lon = float(account['lon'])
+            preset = [account['city_name'], account['text'], float(account['lat']), float(account['lon'])]
+            profile.data.preset_hash = hashlib.sha256(json.dumps(preset, ensure_ascii=False).encode()).hexdigest()
+        profiles[profile.owner_id] = profile
+    return profiles
+
+
+profiles = load_profiles()
+
+
+def get_profile_data(user_id: int) -> SharedData:
+    return profiles[user_id].data
+
+
+STATE_DIR = os.getenv("STATE_DIR", "state")
+
+
+class StateStore:
+    def __init__(self, directory: str, debounce: float = 1.0):
+        self.directory = directory
+        self.debounce = debounce
+        self.pending: Dict[str, asyncio.Task] = {}
+
+    def path(self, profile: Profile) -> str:
+        return os.path.join(self.directory, state_file_name(profile.name))
+
+    def load(self, profile: Profile):
+        path = self.path(profile)
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    profile.data.restore(json.load(f))
+                logger.info(f"Состояние профиля {profile.name} восстановлено")
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Не удалось загрузить состояние {path}: {e}")
+        profile.data.on_change = lambda: self.schedule_save(profile)
+
+    def schedule_save(self, profile: Profile):
+        task = self.pending.get(profile.name)
+        if task is None or task.done():
+            self.pending[profile.name] = asyncio.create_task(self.save_later(profile))
+
+    async def save_later(self, profile: Profile):
+        # Изменения за окно debounce записываются одним разом
+        await asyncio.sleep(self.debounce)
+        await self.save(profile)
+
+    async def save(self, profile: Profile):
+        snapshot = await profile.data.snapshot()
+        try:
+            await asyncio.to_thread(self.write, self.path(profile), snapshot)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить состояние профиля {profile.name}: {e}")
+
+    def write(self, path: str, snapshot: Dict[str, Any]):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    async def flush(self):
+        for task in self.pending.values():
+            task.cancel()
+        self.pending.clear()
+        for profile in profiles.values():
+            await self.save(profile)
+
+
+state_store = StateStore(STATE_DIR)
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
@@ -113,13 +655,14 @@ dp = Dispatcher()
 
 class MessageStore:
     def __init__(self):
-        self.chat_messages = defaultdict(list)
+        # dict как упорядоченное множество: повторные id при редактировании пагинации не дублируются
+        self.chat_messages: defaultdict[int, dict[int, None]] = defaultdict(dict)
 
     def add_message(self, chat_id: int, message_id: int):
-        self.chat_messages[chat_id].append(message_id)
+        self.chat_messages[chat_id][message_id] = None
 
     def get_messages(self, chat_id: int) -> list[int]:
-        return self.chat_messages.get(chat_id, [])
+        return list(self.chat_messages.get(chat_id, {}))
 
     def clear_chat(self, chat_id: int):
         if chat_id in self.chat_messages:
@@ -143,7 +686,7 @@ class AccessMiddleware(BaseMiddleware):
         else:
             return await handler(event, data)
 
-        if user_id != USER_ID:
+        if user_id not in profiles:
             if isinstance(event, types.Message):
                 await event.answer("❌ Извините, этот бот доступен только для авторизованных пользователей.")
             elif isinstance(event, types.CallbackQuery):
@@ -152,6 +695,19 @@ class AccessMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+background_tasks: set[asyncio.Task] = set()
+
+
+async def delete_messages_bulk(chat_id: int, message_ids: list[int]):
+    # deleteMessages принимает не больше 100 id за вызов
+    for start in range(0, len(message_ids), 100):
+        chunk = message_ids[start:start + 100]
+        try:
+            await bot.delete_messages(chat_id, chunk)
+        except Exception as e:
+            logger.error(f"Ошибка удаления сообщений {chunk}: {e}")
+
+
 class CleanupMiddleware(BaseMiddleware):
     async def __call__(
         self,
@@ -174,17 +730,12 @@ class CleanupMiddleware(BaseMiddleware):
                 logger.info(f"Состояние FSM сброшено для команды: {event.text}")
 
             message_ids = message_store.get_messages(event.chat.id)
-            for msg_id in message_ids:
-                try:
-                    await bot.delete_message(event.chat.id, msg_id)
-                except Exception as e:
-                    logger.error(f"Ошибка удаления сообщения {msg_id}: {e}")
+            message_ids.append(event.message_id)
             message_store.clear_chat(event.chat.id)
 
-            try:
-                await event.delete()
-            except Exception as e:
-                logger.error(f"Ошибка удаления команды: {e}")
+            task = asyncio.create_task(delete_messages_bulk(event.chat.id, message_ids))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
 
             return await handler(event, data)
 
@@ -223,25 +774,395 @@ def translate_weather(weather_id: int, current_time: time) -> str:
         return "CLOUD"
 
 
-async def get_city_coordinates(session: aiohttp.ClientSession, city_name: str):
-    url = "https://nominatim.openstreetmap.org/search"
-    params = {'q': city_name, 'countrycodes': 'ru', 'format': 'json'}
-    try:
-        async with session.get(url, params=params, timeout=10) as response:
-            response.raise_for_status()
-            return await response.json()
-    except (aiohttp.ClientError, asyncio.TimeoutError):
-        return None
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "4"))
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "600"))
+WEATHER_BATCH_WINDOW = float(os.getenv("WEATHER_BATCH_WINDOW", "0.2"))
+FORECAST_CACHE_TTL = int(os.getenv("FORECAST_CACHE_TTL", "3600"))
+OPENWEATHER_URL = "https://api.openweathermap.org/data/2.5"
 
+http_session: Optional[aiohttp.ClientSession] = None
 
-async def get_weather_data(session: aiohttp.ClientSession, lat: float, lon: float):
-    url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-    try:
-        async with session.get(url, timeout=10) as response:
-            response.raise_for_status()
-            return await response.json()
-    except (aiohttp.ClientError, asyncio.TimeoutError):
+
+def create_http_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        ttl_dns_cache=300,
+        keepalive_timeout=60
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'User-Agent': 'DynamicProfileTelegram'}
+    )
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+class WeatherCache:
+    def __init__(self, ttl: int, grid: float = 0.01):
+        self.ttl = timedelta(seconds=ttl)
+        self.grid = grid
+        self.entries: Dict[Tuple[float, float], Tuple[datetime, dict]] = {}
+
+    def key(self, lat: float, lon: float) -> Tuple[float, float]:
+        # Привязка к сетке: близкие координаты получают общий ключ
+        return (round(round(lat / self.grid) * self.grid, 6), round(round(lon / self.grid) * self.grid, 6))
+
+    def get(self, lat: float, lon: float) -> Optional[dict]:
+        key = self.key(lat, lon)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, data = entry
+        if clock.now() >= expires:
+            del self.entries[key]
+            return None
+        return data
+
+    def put(self, lat: float, lon: float, data: dict):
+        self.entries[self.key(lat, lon)] = (clock.now() + self.ttl, data)
+
+
+weather_cache = WeatherCache(WEATHER_CACHE_TTL, float(os.getenv("WEATHER_GRID", "0.01")))
+
+
+GEOCODE_DB = os.getenv("GEOCODE_DB", "geocode.sqlite3")
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "256"))
+NOMINATIM_MIN_INTERVAL = float(os.getenv("NOMINATIM_MIN_INTERVAL", "1.0"))
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.casefold().split())
+
+
+class RateLimiter:
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.lock = asyncio.Lock()
+        self.last_call: Optional[datetime] = None
+
+    async def __aenter__(self):
+        await self.lock.acquire()
+        try:
+            if self.last_call is not None:
+                wait = self.min_interval - (datetime.now() - self.last_call).total_seconds()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+        except BaseException:
+            # При отмене во время ожидания __aexit__ не вызовется, блокировку отпускаем сами
+            self.lock.release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.last_call = datetime.now()
+        self.lock.release()
+
+
+class GeocodeCache:
+    def __init__(self, path: Optional[str], max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self.memory: OrderedDict[str, list] = OrderedDict()
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS geocode (query TEXT PRIMARY KEY, result TEXT NOT NULL, created REAL NOT NULL)")
+            self.db.commit()
+        return self.db
+
+    def _load(self, query: str) -> Optional[list]:
+        with self.db_lock:
+            row = self._connect().execute("SELECT result FROM geocode WHERE query = ?", (query,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store(self, query: str, result: list):
+        with self.db_lock:
+            db = self._connect()
+            db.execute("INSERT OR REPLACE INTO geocode (query, result, created) VALUES (?, ?, ?)",
+                       (query, json.dumps(result, ensure_ascii=False), datetime.now().timestamp()))
+            db.commit()
+
+    def _remember(self, query: str, result: list):
+        self.memory[query] = result
+        self.memory.move_to_end(query)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    async def get(self, query: str) -> Optional[list]:
+        result = self.memory.get(query)
+        if result is not None:
+            self.memory.move_to_end(query)
+            return result
+        if not self.path:
+            return None
+        try:
+            result = await asyncio.to_thread(self._load, query)
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка чтения кэша геокодинга: {e}")
+            return None
+        if result is not None:
+            self._remember(query, result)
+        return result
+
+    async def put(self, query: str, result: list):
+        self._remember(query, result)
+        if not self.path or not result:
+            return
+        try:
+            await asyncio.to_thread(self._store, query, result)
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка записи кэша геокодинга: {e}")
+
+
+geocode_cache = GeocodeCache(GEOCODE_DB or None, GEOCODE_CACHE_SIZE)
+nominatim_limiter = RateLimiter(NOMINATIM_MIN_INTERVAL)
+
+
+class NominatimBackend:
+    URL = "https://nominatim.openstreetmap.org/search"
+
+    async def search(self, query: str) -> Optional[list]:
+        params = {'q': query, 'countrycodes': 'ru', 'format': 'json'}
+        try:
+            async with get_http_session().get(self.URL, params=params, timeout=10) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+
+class FakeGeocodeBackend:
+    def __init__(self, faults: FaultInjector):
+        self.faults = faults
+
+    async def search(self, query: str) -> Optional[list]:
+        try:
+            await self.faults()
+        except ConnectionError:
+            return None
+        seed = int(hashlib.sha256(query.encode()).hexdigest()[:8], 16)
+        return [{
+            'type': 'city',
+            'display_name': f"{query.title()}, вариант {index + 1}",
+            'lat': str(45 + seed % 2000 / 100 + index),
+            'lon': str(30 + seed % 9000 / 100 + index),
+        } for index in range(3)]
+
+
+async def get_city_coordinates(city_name: str):
+    query = normalize_query(city_name)
+    cached = await geocode_cache.get(query)
+    if cached is not None:
+        metrics.inc("geocode_cache_hits")
+        return cached
+    metrics.inc("geocode_cache_misses")
+
+    async with nominatim_limiter:
+        # Запрос мог быть выполнен, пока ждали своей очереди
+        cached = await geocode_cache.get(query)
+        if cached is not None:
+            return cached
+        result = await geocode_backend.search(city_name)
+    if result is None:
         return None
+    await geocode_cache.put(query, result)
+    return result
+
+
+class OpenWeatherBackend:
+    async def get_json(self, url: str) -> Optional[dict]:
+        try:
+            async with get_http_session().get(url, timeout=10) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    async def current(self, lat: float, lon: float) -> Optional[dict]:
+        return await self.get_json(
+            f"{OPENWEATHER_URL}/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru")
+
+    async def group(self, city_ids: list[int]) -> Optional[list]:
+        payload = await self.get_json(
+            f"{OPENWEATHER_URL}/group?id={','.join(map(str, city_ids))}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru")
+        return payload.get('list', []) if payload else None
+
+    async def forecast(self, lat: float, lon: float) -> Optional[dict]:
+        return await self.get_json(
+            f"{OPENWEATHER_URL}/forecast?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru")
+
+
+class FakeWeatherBackend:
+    WEATHER_IDS = (800, 801, 803, 500, 600, 701)
+
+    def __init__(self, faults: FaultInjector):
+        self.faults = faults
+
+    @staticmethod
+    def city_id(lat: float, lon: float) -> int:
+        return int(abs(lat) * 100) * 100000 + int(abs(lon) * 100)
+
+    def make(self, city_id: int, moment: Optional[datetime] = None) -> dict:
+        # Суточный ход температуры и смена погоды раз в три модельных часа
+        now = moment or clock.now()
+        hour = now.hour + now.minute / 60
+        temp = 5 + 10 * math.sin((hour - 9) / 24 * 2 * math.pi) + city_id % 7
+        weather_id = self.WEATHER_IDS[(city_id + now.hour // 3) % len(self.WEATHER_IDS)]
+        return {'id': city_id, 'timezone': 10800, 'sys': {'timezone': 10800},
+                'main': {'temp': round(temp, 1)}, 'weather': [{'id': weather_id}]}
+
+    async def current(self, lat: float, lon: float) -> Optional[dict]:
+        try:
+            await self.faults()
+        except ConnectionError:
+            return None
+        return self.make(self.city_id(lat, lon))
+
+    async def forecast(self, lat: float, lon: float) -> Optional[dict]:
+        try:
+            await self.faults()
+        except ConnectionError:
+            return None
+        # Как у OpenWeather: 40 точек с шагом три часа, начиная со следующей трехчасовой отметки
+        city_id = self.city_id(lat, lon)
+        start = clock.now().replace(minute=0, second=0, microsecond=0)
+        start += timedelta(hours=3 - start.hour % 3)
+        entries = []
+        for step in range(40):
+            moment = start + timedelta(hours=3 * step)
+            entry = self.make(city_id, moment)
+            entry['dt'] = int(moment.timestamp())
+            entries.append(entry)
+        return {'city': {'id': city_id, 'timezone': 10800}, 'list': entries}
+
+    async def group(self, city_ids: list[int]) -> Optional[list]:
+        try:
+            await self.faults()
+        except ConnectionError:
+            return None
+        return [self.make(city_id) for city_id in city_ids]
+
+
+class WeatherCoordinator:
+    GROUP_LIMIT = 20  # Максимум id в одном запросе /group
+
+    def __init__(self, cache: WeatherCache, batch_window: float, backend):
+        self.cache = cache
+        self.batch_window = batch_window
+        self.backend = backend
+        self.inflight: Dict[Tuple[float, float], asyncio.Future] = {}
+        self.queue: Dict[Tuple[float, float], Tuple[float, float]] = {}
+        self.city_ids: Dict[Tuple[float, float], int] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+        self.forecasts = WeatherCache(FORECAST_CACHE_TTL, cache.grid)
+        self.forecast_inflight: Dict[Tuple[float, float], asyncio.Future] = {}
+
+    async def get(self, lat: float, lon: float) -> Optional[dict]:
+        cached = self.cache.get(lat, lon)
+        if cached is not None:
+            metrics.inc("weather_cache_hits")
+            return cached
+        metrics.inc("weather_cache_misses")
+
+        key = self.cache.key(lat, lon)
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.inflight[key] = future
+            self.queue[key] = (lat, lon)
+            if self.flush_task is None:
+                self.flush_task = asyncio.create_task(self.flush())
+        return await asyncio.shield(future)
+
+    async def flush(self):
+        # Собираем запросы, пришедшие в одно окно, и отправляем их пачкой
+        await asyncio.sleep(self.batch_window)
+        batch, self.queue = self.queue, {}
+        self.flush_task = None
+
+        results: Dict[Tuple[float, float], Optional[dict]] = {}
+        try:
+            known = {key: self.city_ids[key] for key in batch if key in self.city_ids}
+            if len(known) > 1:
+                results.update(await self.fetch_group(known))
+
+            rest = [key for key in batch if key not in results]
+            fetched = await asyncio.gather(*(self.backend.current(*batch[key]) for key in rest))
+            results.update(zip(rest, fetched))
+        except Exception as e:
+            logger.error(f"Ошибка получения погоды: {e}")
+
+        for key in batch:
+            data = results.get(key)
+            if data is not None:
+                self.cache.put(*key, data)
+                if 'id' in data:
+                    self.city_ids[key] = data['id']
+            future = self.inflight.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    async def fetch_group(self, known: Dict[Tuple[float, float], int]) -> Dict[Tuple[float, float], dict]:
+        keys_by_id = {city_id: key for key, city_id in known.items()}
+        ids = list(keys_by_id)
+        results = {}
+        for start in range(0, len(ids), self.GROUP_LIMIT):
+            items = await self.backend.group(ids[start:start + self.GROUP_LIMIT])
+            for item in items or []:
+                # В ответе /group часовой пояс лежит в sys, а не в корне
+                if 'timezone' not in item:
+                    item['timezone'] = item.get('sys', {}).get('timezone')
+                key = keys_by_id.get(item.get('id'))
+                if key is not None and item['timezone'] is not None:
+                    results[key] = item
+        return results
+
+    async def forecast(self, lat: float, lon: float) -> Optional[dict]:
+        cached = self.forecasts.get(lat, lon)
+        if cached is not None:
+            return cached
+
+        # Профили из одного города делят и кэш, и запрос в полете
+        key = self.forecasts.key(lat, lon)
+        future = self.forecast_inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.forecast_inflight[key] = future
+
+        data = None
+        try:
+            data = await self.backend.forecast(lat, lon)
+            if data is not None:
+                self.forecasts.put(lat, lon, data)
+        except Exception as e:
+            logger.error(f"Ошибка получения прогноза: {e}")
+        finally:
+            self.forecast_inflight.pop(key, None)
+            future.set_result(data)
+        return data
+
+
+if BACKENDS == "fake":
+    weather_backend = FakeWeatherBackend(FaultInjector(FAKE_LATENCY, FAKE_FAILURE_RATE))
+    geocode_backend = FakeGeocodeBackend(FaultInjector(FAKE_LATENCY, FAKE_FAILURE_RATE))
+else:
+    weather_backend = OpenWeatherBackend()
+    geocode_backend = NominatimBackend()
+
+weather_coordinator = WeatherCoordinator(weather_cache, WEATHER_BATCH_WINDOW, weather_backend)
+
+
+async def get_weather_data(lat: float, lon: float):
+    return await weather_coordinator.get(lat, lon)
 
 
 @dp.message(Command("set"))
@@ -258,14 +1179,13 @@ async def cmd_set(message: types.Message, state: FSMContext):
 @dp.message(CitySelection.choosing_city, F.text)
 async def process_city_name(message: types.Message, state: FSMContext):
     city_name = message.text.strip()
-    async with aiohttp.ClientSession() as session:
-        cities = await get_city_coordinates(session, city_name)
-        if not cities:
-            msg = await message.answer("❌ Населенный пункт не найден. Попробуйте еще раз:")
-            message_store.add_message(message.chat.id, msg.message_id)
-            return
-        await state.update_data(cities=cities, current_index=0)
-        await show_city_pagination(message, state)
+    cities = await get_city_coordinates(city_name)
+    if not cities:
+        msg = await message.answer("❌ Населенный пункт не найден. Попробуйте еще раз:")
+        message_store.add_message(message.chat.id, msg.message_id)
+        return
+    await state.update_data(cities=cities, current_index=0)
+    await show_city_pagination(message, state)
 
 
 async def show_city_pagination(message: types.Message, state: FSMContext):
@@ -352,7 +1272,7 @@ async def process_profile_text(message: types.Message, state: FSMContext):
     lon = float(city['lon'])
     city_name = city['display_name']
 
-    await shared_data.update(city_name, profile_text, lat, lon)
+    await get_profile_data(message.from_user.id).update(city_name, profile_text, lat, lon)
     msg = await message.answer("💾 Надпись принята! Данные сохранены.")
     message_store.add_message(message.chat.id, msg.message_id)
     await state.clear()
@@ -394,8 +1314,9 @@ async def confirm_stop(callback: types.CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка при удалении сообщения: {e}")
 
-    await shared_data.stop()
-    await dp.stop_polling()
+    await get_profile_data(callback.from_user.id).stop()
+    if not any(profile.data.is_running() for profile in profiles.values()):
+        await dp.stop_polling()
 
 
 @dp.callback_query(F.data == "cancel_stop")
@@ -416,17 +1337,26 @@ async def cancel_stop(callback: types.CallbackQuery):
 
 @dp.message(Command("info"))
 async def cmd_info(message: types.Message):
-    city_name, profile_text, _, _ = await shared_data.get()
-    last_update = await shared_data.get_last_time()
-    _, flood_until = await shared_data.get_flood_info()
+    profile_data = get_profile_data(message.from_user.id)
+    profile_name = profiles[message.from_user.id].name
+    city_name, profile_text, _, _ = await profile_data.get()
+    last_update = await profile_data.get_last_time()
+    _, flood_until = await profile_data.get_flood_info()
+    skipped_uploads = await profile_data.get_skipped_uploads()
+    interval = await profile_data.get_effective_interval()
+    remaining_uploads, _ = await profile_data.get_upload_budget()
+    if remaining_uploads is None:
+        upload_budget_text = "без ограничения"
+    else:
+        upload_budget_text = f"{remaining_uploads} из {UPLOADS_PER_HOUR}"
 
     last_update_text = "еще не обновлялся"
     if last_update:
         last_update_text = last_update.strftime("%H:%M:%S")
 
     flood_status = "🟢 нет ограничений"
-    if flood_until and datetime.now() < flood_until:
-        remaining = int((flood_until - datetime.now()).total_seconds())
+    if flood_until and clock.now() < flood_until:
+        remaining = int((flood_until - clock.now()).total_seconds())
 
         hours = remaining // 3600
         hours = f'{hours:02d}' if hours < 10 else hours
@@ -440,8 +1370,18 @@ async def cmd_info(message: types.Message):
         "<b>📊 Статус бота</b>\n\n"
         f"<b>Последнее обновление:</b> {last_update_text}\n"
         f"<b>Ограничения:</b> {flood_status}\n"
+        f"<b>Интервал обновления:</b> {interval} мин\n"
+        f"<b>Осталось загрузок в этот час:</b> {upload_budget_text}\n"
         f"<b>Текущая надпись:</b> {profile_text or 'не установлена'}\n"
-        f"<b>Населенный пункт:</b> {city_name or 'не установлен'}"
+        f"<b>Населенный пункт:</b> {city_name or 'не установлен'}\n"
+        f"<b>Рендер:</b> {render_pool.stats.summary()}\n"
+        f"<b>Пропущено загрузок:</b> {skipped_uploads}\n"
+        f"<b>Этапы обновления:</b> {metrics.summary(profile=profile_name)}\n"
+        f"<b>Кэши:</b> погода {int(metrics.value('weather_cache_hits'))}/"
+        f"{int(metrics.value('weather_cache_misses'))}, "
+        f"геокодинг {int(metrics.value('geocode_cache_hits'))}/"
+        f"{int(metrics.value('geocode_cache_misses'))}, "
+        f"подбор текста {text_fit_cache.hits}/{text_fit_cache.misses} (попадания/промахи)"
     )
 
     msg = await message.answer(info_text, parse_mode="HTML")
@@ -453,29 +1393,37 @@ def place_overlay_on_base(base: Image, overlay: Image, x: int, y: int):
     base.paste(overlay, position, overlay)
 
 
-def draw_scaled_text(image: Image, text: str, box: tuple, font_path: str,
-                     color: tuple = (255, 255, 255), size_fonts: int = -1):
-    left, top, right, bottom = box
-    area_width = right - left
-    area_height = bottom - top
-    draw = ImageDraw.Draw(image)
+class TextLayout:
+    def __init__(self, font: ImageFont.FreeTypeFont):
+        self.font = font
+        self.advances: Dict[str, float] = {}
+        bbox = font.getbbox("Hg")
+        self.line_height = bbox[3] - bbox[1]
 
-    words = text.split()
+    def char_width(self, char: str) -> float:
+        width = self.advances.get(char)
+        if width is None:
+            width = self.font.getlength(char)
+            self.advances[char] = width
+        return width
 
-    def split_text(font):
+    def width(self, text: str) -> float:
+        return sum(self.char_width(char) for char in text)
+
+    def split(self, words: list[str], area_width: int) -> list[str]:
         lines = []
         current_line = []
         current_width = 0
-        space_width = draw.textlength(" ", font=font)
+        space_width = self.char_width(" ")
 
         for word in words:
-            word_width = draw.textlength(word, font=font)
+            word_width = self.width(word)
 
             if word_width > area_width and not current_line:
                 parts = []
                 part = ""
                 for char in word:
-                    char_width = draw.textlength(char, font=font)
+                    char_width = self.char_width(char)
                     if current_width + char_width <= area_width:
                         part += char
                         current_width += char_width
@@ -505,63 +1453,233 @@ def draw_scaled_text(image: Image, text: str, box: tuple, font_path: str,
 
         return lines
 
-    def calculate_height(lines, font):
-        if not lines:
-            return 0
-        bbox = draw.textbbox((0, 0), "Hg", font=font)
-        line_height = bbox[3] - bbox[1]
-        return len(lines) * line_height * 1.1
+
+class FontRegistry:
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.layouts: OrderedDict[Tuple[str, int], TextLayout] = OrderedDict()
+
+    def layout(self, font_path: str, size: int) -> TextLayout:
+        key = (font_path, size)
+        with self.lock:
+            layout = self.layouts.get(key)
+            if layout is not None:
+                self.layouts.move_to_end(key)
+                return layout
+
+            layout = TextLayout(ImageFont.truetype(font_path, size))
+            self.layouts[key] = layout
+            if len(self.layouts) > self.max_size:
+                self.layouts.popitem(last=False)
+            return layout
+
+
+font_registry = FontRegistry(int(os.getenv("FONT_CACHE_SIZE", "64")))
+
+
+class TextFitCache:
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple, Tuple[int, list[str]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[Tuple[int, list[str]]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, size: int, lines: list[str]):
+        with self.lock:
+            self.entries[key] = (size, lines)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+text_fit_cache = TextFitCache(int(os.getenv("TEXT_FIT_CACHE_SIZE", "256")))
+
+
+def fit_text(text: str, box: tuple, font_path: str, size_fonts: int = -1) -> Tuple[TextLayout, list[str]]:
+    # Цвет на подбор размера не влияет, поэтому в ключ не входит
+    key = (text, box, font_path, size_fonts)
+    cached = text_fit_cache.get(key)
+    if cached is not None:
+        size, lines = cached
+        return font_registry.layout(font_path, size), lines
+
+    left, top, right, bottom = box
+    area_width = right - left
+    area_height = bottom - top
+
+    words = text.split()
 
     if size_fonts != -1:
-        best_font = ImageFont.truetype(font_path, size_fonts)
-        best_lines = split_text(best_font)
+        best_layout = font_registry.layout(font_path, size_fonts)
+        best_lines = best_layout.split(words, area_width)
 
     else:
         min_font_size = 10
         max_font_size = 277
-        best_font = None
+        best_layout = None
         best_lines = None
 
         while min_font_size <= max_font_size:
             mid_font_size = (min_font_size + max_font_size) // 2
             try:
-                current_font = ImageFont.truetype(font_path, mid_font_size)
+                current_layout = font_registry.layout(font_path, mid_font_size)
             except:
-                current_font = ImageFont.truetype(font_path, 10)
-
-            lines = split_text(current_font)
-            text_height = calculate_height(lines, current_font)
+                current_layout = font_registry.layout(font_path, 10)
 
-            max_line_width = 0
-            for line in lines:
-                line_width = draw.textlength(line, font=current_font)
-                if line_width > max_line_width:
-                    max_line_width = line_width
+            lines = current_layout.split(words, area_width)
+            text_height = len(lines) * current_layout.line_height * 1.1 if lines else 0
+            max_line_width = max((current_layout.width(line) for line in lines), default=0)
 
             if text_height <= area_height and max_line_width <= area_width:
-                best_font = current_font
+                best_layout = current_layout
                 best_lines = lines
                 min_font_size = mid_font_size + 1
             else:
                 max_font_size = mid_font_size - 1
 
-        if best_font is None:
-            best_font = ImageFont.truetype(font_path, min_font_size)
-            best_lines = split_text(best_font)
+        if best_layout is None:
+            best_layout = font_registry.layout(font_path, min_font_size)
+            best_lines = best_layout.split(words, area_width)
+
+    text_fit_cache.put(key, best_layout.font.size, best_lines)
+    return best_layout, best_lines
+
+
+GLYPH_ATLAS_ALPHABET = frozenset("0123456789:+-")
+
+
+class GlyphAtlas:
+    # Маски символов растрируются один раз на (шрифт, размер); цвет подставляется при вставке,
+    # поэтому одна маска годится для любого цвета
+    def __init__(self, max_size: int = 512):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.glyphs: Dict[Tuple[str, int, str], Tuple[Image.Image, Tuple[int, int]]] = {}
+        self.strings: OrderedDict[Tuple[str, int, str], Tuple[Image.Image, Tuple[int, int], float]] = OrderedDict()
+        self.verified: Dict[Tuple[str, int], bool] = {}
+
+    @staticmethod
+    def rasterize(font: ImageFont.FreeTypeFont, text: str) -> Tuple[Image.Image, Tuple[int, int]]:
+        x0, y0, x1, y1 = font.getbbox(text)
+        mask = Image.new("L", (max(x1 - x0, 1), max(y1 - y0, 1)), 0)
+        ImageDraw.Draw(mask).text((-x0, -y0), text, font=font, fill=255)
+        return mask, (x0, y0)
+
+    def glyph(self, font_path: str, layout: TextLayout, char: str) -> Tuple[Image.Image, Tuple[int, int]]:
+        key = (font_path, layout.font.size, char)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            glyph = self.rasterize(layout.font, char)
+            self.glyphs[key] = glyph
+        return glyph
+
+    def compose(self, font_path: str, layout: TextLayout, text: str) -> Tuple[Image.Image, Tuple[int, int]]:
+        font = layout.font
+        x0, y0, x1, y1 = font.getbbox(text)
+        mask = Image.new("L", (max(x1 - x0, 1), max(y1 - y0, 1)), 0)
+        for index, char in enumerate(text):
+            glyph, (gx, gy) = self.glyph(font_path, layout, char)
+            # getlength учитывает кернинг, FreeType округляет перо до целого пикселя
+            pen = math.floor(font.getlength(text[:index]) + 0.5)
+            left, top = pen + gx - x0, gy - y0
+            region = (left, top, left + glyph.width, top + glyph.height)
+            mask.paste(ImageChops.lighter(mask.crop(region), glyph), region)
+        return mask, (x0, y0)
+
+    def verify(self, font_path: str, layout: TextLayout) -> bool:
+        # Сборка из спрайтов сверяется с растром FreeType один раз на (шрифт, размер) — на всех парах
+        # символов алфавита, где проявляются кернинг и перекрытия глифов
+        alphabet = sorted(GLYPH_ATLAS_ALPHABET)
+        for text in [first + second for first in alphabet for second in alphabet] + ["".join(alphabet)]:
+            mask, offset = self.compose(font_path, layout, text)
+            reference, reference_offset = self.rasterize(layout.font, text)
+            if offset != reference_offset or mask.size != reference.size or \
+                    ImageChops.difference(mask, reference).getbbox() is not None:
+                logger.debug(f"Атлас глифов: строка {text!r} не совпала с растром FreeType")
+                return False
+        return True
+
+    def line(self, font_path: str, layout: TextLayout,
+             text: str) -> Optional[Tuple[Image.Image, Tuple[int, int], float]]:
+        key = (font_path, layout.font.size, text)
+        with self.lock:
+            entry = self.strings.get(key)
+            if entry is not None:
+                self.strings.move_to_end(key)
+                return entry
+
+            font_key = (font_path, layout.font.size)
+            verified = self.verified.get(font_key)
+            if verified is None:
+                verified = self.verified[font_key] = self.verify(font_path, layout)
+                if not verified:
+                    logger.warning(f"Атлас глифов отключен для {font_path} ({layout.font.size}): "
+                                   f"сборка из спрайтов не совпадает с FreeType")
+            if not verified:
+                return None
+
+            mask, offset = self.compose(font_path, layout, text)
+            entry = (mask, offset, layout.font.getlength(text))
+            self.strings[key] = entry
+            if len(self.strings) > self.max_size:
+                self.strings.popitem(last=False)
+            return entry
+
+
+glyph_atlas = GlyphAtlas(int(os.getenv("GLYPH_ATLAS_SIZE", "512")))
+
+
+def draw_atlas_line(image: Image, mask: Image.Image, offset: Tuple[int, int], x: float, y: float, color: tuple):
+    # То же размещение, что у ImageDraw.text: целая часть координаты плюс смещение растра
+    image.paste(color, (int(x) + offset[0], int(y) + offset[1]), mask)
 
-    bbox = draw.textbbox((0, 0), "Hg", font=best_font)
-    line_height = bbox[3] - bbox[1]
+
+def draw_scaled_text(image: Image, text: str, box: tuple, font_path: str,
+                     color: tuple = (255, 255, 255), size_fonts: int = -1):
+    left, top, right, bottom = box
+    area_width = right - left
+    area_height = bottom - top
+    draw = ImageDraw.Draw(image)
+
+    best_layout, best_lines = fit_text(text, box, font_path, size_fonts)
+
+    best_font = best_layout.font
+    line_height = best_layout.line_height
     spacing = line_height * 0.1
 
     total_height = len(best_lines) * line_height + \
         (len(best_lines) - 1) * spacing
     y = top + (area_height - total_height) // 2
 
+    # Время и температура рисуются фиксированным размером из небольшого алфавита — берем их из атласа
+    use_atlas = size_fonts != -1 and y == int(y)
+
     for line in best_lines:
-        line_width = draw.textlength(line, font=best_font)
-        x = left + (area_width - line_width) // 2
-        draw.text((x, y), line, font=best_font, fill=color)
+        entry = None
+        if use_atlas and GLYPH_ATLAS_ALPHABET.issuperset(line):
+            entry = glyph_atlas.line(font_path, best_layout, line)
+        if entry is not None:
+            mask, offset, line_width = entry
+            x = left + (area_width - line_width) // 2
+            draw_atlas_line(image, mask, offset, x, y, color)
+        else:
+            line_width = best_font.getlength(line)
+            x = left + (area_width - line_width) // 2
+            draw.text((x, y), line, font=best_font, fill=color)
         y += line_height + spacing
+        use_atlas = use_atlas and y == int(y)
 
 
 def draw_clock(clock: Image, hour_img: Image, minute_img: Image, time_str: str):
@@ -599,119 +1717,914 @@ def draw_clock(clock: Image, hour_img: Image, minute_img: Image, time_str: str):
     clock.alpha_composite(minute_rot, dest=(center_x - m_cx, center_y - m_cy))
 
 
+class ClockAtlas:
+    SOURCES = ("CLOCK", "HOUR_HAND", "MINUTE_HAND")
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir
+        self.faces: Dict[Tuple[int, int], Image.Image] = {}
+        self.lock = threading.Lock()
+        self.sources_hash: Optional[str] = None
+
+    def get_sources_hash(self) -> str:
+        if self.sources_hash is None:
+            digest = hashlib.sha256()
+            for name in self.SOURCES:
+                with open(f"images/{name.lower()}.png", "rb") as f:
+                    digest.update(f.read())
+            self.sources_hash = digest.hexdigest()[:16]
+        return self.sources_hash
+
+    def face_path(self, key: Tuple[int, int]) -> str:
+        # Разрешение входит в ключ, чтобы кэши разных OUTPUT_SIZE не смешивались
+        face_width = scaled_size(SOURCE_IMAGES["CLOCK"].size, RENDER_SCALE)[0]
+        return os.path.join(self.cache_dir, f"{self.get_sources_hash()}_{face_width}",
+                            f"{key[0]:02d}{key[1]:02d}.png")
+
+    def render_face(self, key: Tuple[int, int]) -> Image.Image:
+        # Стрелки поворачиваются на исходных спрайтах, уменьшается уже готовый циферблат
+        clock = SOURCE_IMAGES["CLOCK"].copy()
+        draw_clock(clock, SOURCE_IMAGES["HOUR_HAND"], SOURCE_IMAGES["MINUTE_HAND"], f"{key[0]:02d}:{key[1]:02d}")
+        if RENDER_SCALE != 1:
+            clock = clock.resize(scaled_size(clock.size, RENDER_SCALE), Image.LANCZOS)
+        return clock
+
+    def load_or_render(self, key: Tuple[int, int]) -> Image.Image:
+        if not self.cache_dir:
+            return self.render_face(key)
+
+        path = self.face_path(key)
+        if os.path.exists(path):
+            try:
+                with Image.open(path) as cached:
+                    return cached.convert("RGBA")
+            except Exception as e:
+                logger.warning(f"Повреждённый кэш циферблата {path}: {e}")
+
+        face = self.render_face(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Воркеры пула процессов прогревают атлас одновременно — пишем через временный файл
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            face.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить циферблат {path}: {e}")
+        return face
+
+    def get(self, time_str: str) -> Image.Image:
+        hours, minutes = map(int, time_str.split(":"))
+        key = (hours % 12, minutes)
+        face = self.faces.get(key)
+        if face is None:
+            with self.lock:
+                face = self.faces.get(key)
+                if face is None:
+                    face = self.load_or_render(key)
+                    self.faces[key] = face
+        return face
+
+    def warm(self):
+        for hours in range(12):
+            for minutes in range(0, 60, FIXED_INTERVAL if 60 % FIXED_INTERVAL == 0 else 5):
+                self.get(f"{hours:02d}:{minutes:02d}")
+        logger.info(f"Атлас циферблатов готов ({len(self.faces)} положений)")
+
+
+clock_atlas = ClockAtlas(os.getenv("CLOCK_CACHE_DIR") or None)
+CLOCK_ATLAS_PREWARM = os.getenv("CLOCK_ATLAS_PREWARM", "1") == "1"
+
+
+class LayeredRenderer:
+    def __init__(self, max_layers: int = 8):
+        self.lock = threading.Lock()
+        self.max_layers = max_layers
+        # По слою на каждую надпись, чтобы профили с разными надписями не вытесняли друг друга
+        self.static_layers: OrderedDict[str, Image.Image] = OrderedDict()
+
+    def get_static_layer(self, city: str) -> Image.Image:
+        with self.lock:
+            layer = self.static_layers.get(city)
+            if layer is None:
+                layer = I["TEMPLATE"].copy()
+                draw_scaled_text(layer, city, CITY_BOX, FONT_PATH)
+                draw_scaled_text(layer, "°C", C_BOX, FONT_PATH)
+                self.static_layers[city] = layer
+                if len(self.static_layers) > self.max_layers:
+                    self.static_layers.popitem(last=False)
+            else:
+                self.static_layers.move_to_end(city)
+            return layer
+
+    def render(self, city: str, time_str: str, temp: str, weather: str) -> Image.Image:
+        base = self.get_static_layer(city).copy()
+
+        draw_scaled_text(base, time_str, TIME_BOX, FONT_PATH, size_fonts=TIME_FONT_SIZE)
+        draw_scaled_text(base, temp, TEMP_BOX, FONT_PATH, size_fonts=TIME_FONT_SIZE)
+
+        place_overlay_on_base(base, clock_atlas.get(time_str), *CLOCK_ANCHOR)
+        place_overlay_on_base(base, I[weather], *WEATHER_ANCHOR)
+
+        return base
+
+
+layered_renderer = LayeredRenderer(int(os.getenv("STATIC_LAYER_CACHE_SIZE", "8")))
+
+
 def generate_icon(city: str, time_str: str, temp: str, weather: str) -> Image:
-    base = I["TEMPLATE"].copy()
-    clock = I["CLOCK"].copy()
+    return layered_renderer.render(city, time_str, temp, weather)
+
+
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "thread")  # thread | process
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "1"))
+
+
+def init_render_worker():
+    for img in I.values():
+        img.load()
+    font_registry.layout(FONT_PATH, TIME_FONT_SIZE)
+    # В пуле процессов у каждого воркера свой атлас, родительский им не виден
+    if RENDER_BACKEND == "process" and CLOCK_ATLAS_PREWARM:
+        try:
+            clock_atlas.warm()
+        except Exception as e:
+            logger.error(f"Не удалось прогреть атлас циферблатов: {e}", exc_info=True)
+
+
+AVATAR_ENCODER = os.getenv("AVATAR_ENCODER", "png")  # png | png-palette | jpeg | auto
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "6"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "90"))
+AUTO_MAX_DIFFERENCE = float(os.getenv("AUTO_MAX_DIFFERENCE", "1.5"))
+
+
+def encode_png(icon: Image.Image) -> bytes:
+    with io.BytesIO() as buffer:
+        icon.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+        return buffer.getvalue()
+
+
+def encode_png_palette(icon: Image.Image) -> bytes:
+    palette = icon.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    with io.BytesIO() as buffer:
+        palette.save(buffer, format='PNG', optimize=True, compress_level=PNG_COMPRESS_LEVEL)
+        return buffer.getvalue()
+
 
-    draw_scaled_text(base, city, CITY_BOX, FONT_PATH)
-    draw_scaled_text(base, "°C", C_BOX, FONT_PATH)
-    draw_scaled_text(base, time_str, TIME_BOX, FONT_PATH, size_fonts=160)
-    draw_scaled_text(base, temp, TEMP_BOX, FONT_PATH, size_fonts=160)
+def encode_jpeg(icon: Image.Image) -> bytes:
+    with io.BytesIO() as buffer:
+        icon.convert("RGB").save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+        return buffer.getvalue()
 
-    draw_clock(clock, I["HOUR_HAND"], I["MINUTE_HAND"], time_str)
-    place_overlay_on_base(base, clock, 170, 772)
-    place_overlay_on_base(base, I[weather], 755, 772)
 
-    return base
+ENCODERS: Dict[str, Tuple[Callable[[Image.Image], bytes], str]] = {
+    "png": (encode_png, "icon.png"),
+    "png-palette": (encode_png_palette, "icon.png"),
+    "jpeg": (encode_jpeg, "icon.jpg"),
+}
 
 
-def round_to_nearest_5_minutes(dt: datetime) -> datetime:
-    minute = dt.minute
-    rounded_minute = (minute // 5) * 5
-    if minute % 5 >= 3:
-        rounded_minute += 5
-    if rounded_minute >= 60:
-        rounded_minute = 0
-        dt += timedelta(hours=1)
-    return dt.replace(minute=rounded_minute, second=0, microsecond=0)
+def frame_difference(icon: Image.Image, data: bytes) -> float:
+    # Средняя поканальная разница (0-255) между исходным кадром и декодированным результатом
+    with Image.open(io.BytesIO(data)) as decoded:
+        # Палитровый PNG с прозрачностью конвертируется через RGBA, иначе Pillow предупреждает на каждом кадре
+        diff = ImageChops.difference(icon.convert("RGB"), decoded.convert("RGBA").convert("RGB"))
+    return sum(ImageStat.Stat(diff).mean) / 3
 
 
-async def run_telethon():
-    client = TelegramClient(SESSION_NAME, TELEGRAM_API_ID, TELEGRAM_API_HASH)
-    await client.start()
-    logger.info("Автосмена аватара запущена")
-    to_delete = []
+def encode_icon(icon: Image.Image, mode: str = AVATAR_ENCODER) -> Tuple[bytes, str]:
+    if mode != "auto":
+        encoder, file_name = ENCODERS[mode]
+        return encoder(icon), file_name
 
-    while shared_data.is_running():
+    best_data, best_name = encode_png(icon), "icon.png"
+    for name in ("png-palette", "jpeg"):
+        encoder, file_name = ENCODERS[name]
+        data = encoder(icon)
+        if len(data) < len(best_data) and frame_difference(icon, data) <= AUTO_MAX_DIFFERENCE:
+            best_data, best_name = data, file_name
+    return best_data, best_name
+
+
+def render_frame(city: str, time_str: str, temp: str, weather: str) -> Tuple[bytes, str, float, float, float]:
+    started = datetime.now().timestamp()
+    icon = generate_icon(city, time_str, temp, weather)
+    rendered = datetime.now().timestamp()
+    data, file_name = encode_icon(icon)
+    return data, file_name, started, rendered, datetime.now().timestamp()
+
+
+class RenderStats:
+    def __init__(self):
+        self.frames = 0
+        self.total_render = 0.0
+        self.total_encode = 0.0
+        self.total_queue = 0.0
+        self.total_bytes = 0
+        self.max_queue = 0.0
+
+    def record(self, queue_seconds: float, render_seconds: float, encode_seconds: float, size: int):
+        self.frames += 1
+        self.total_render += render_seconds
+        self.total_encode += encode_seconds
+        self.total_queue += queue_seconds
+        self.total_bytes += size
+        self.max_queue = max(self.max_queue, queue_seconds)
+
+    def summary(self) -> str:
+        if not self.frames:
+            return "кадров еще не было"
+        return (f"{self.frames} кадр(ов), рендер {self.total_render / self.frames:.2f} с, "
+                f"кодирование {self.total_encode / self.frames:.2f} с, "
+                f"{self.total_bytes / self.frames / 1024:.0f} КБ, "
+                f"очередь {self.total_queue / self.frames:.2f} с (макс. {self.max_queue:.2f} с)")
+
+
+class RenderPool:
+    def __init__(self, backend: str, workers: int, metric_prefix: str = ""):
+        self.backend = backend
+        self.workers = workers
+        # Пакетный пул пишет метрики под своими именами, чтобы не смешиваться с задержками живых тиков
+        self.metric_prefix = metric_prefix
+        self.executor: Optional[Executor] = None
+        self.stats = RenderStats()
+
+    def start(self):
+        if self.backend == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_render_worker
+            )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers,
+                thread_name_prefix="render",
+                initializer=init_render_worker
+            )
+        kind = "пакетного рендера" if self.metric_prefix else "рендера"
+        logger.info(f"Пул {kind} запущен ({self.backend}, воркеров: {self.workers})")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def render(self, city: str, time_str: str, temp: str, weather: str) -> Tuple[bytes, str]:
+        if self.executor is None:
+            self.start()
+        submitted = datetime.now().timestamp()
+        loop = asyncio.get_running_loop()
+        data, file_name, started, rendered, finished = await loop.run_in_executor(
+            self.executor, render_frame, city, time_str, temp, weather)
+        queued = max(started - submitted, 0.0)
+        self.stats.record(queued, rendered - started, finished - rendered, len(data))
+        metrics.observe(f"{self.metric_prefix}render_queue", queued)
+        metrics.observe(f"{self.metric_prefix}render", rendered - started)
+        metrics.observe(f"{self.metric_prefix}encode", finished - rendered)
+        metrics.inc(f"{self.metric_prefix}encoded_bytes", len(data))
+        logger.log(logging.DEBUG if self.metric_prefix else logging.INFO,
+                   f"Кадр {time_str} отрисован за {rendered - started:.2f} с, "
+                   f"закодирован в {file_name} за {finished - rendered:.2f} с ({len(data) / 1024:.0f} КБ, "
+                   f"в очереди {queued:.2f} с)")
+        return data, file_name
+
+
+render_pool = RenderPool(RENDER_BACKEND, RENDER_WORKERS)
+
+
+def round_to_interval(dt: datetime, interval: int = FIXED_INTERVAL) -> datetime:
+    day_start = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    minutes = dt.hour * 60 + dt.minute
+    rounded_minutes = (minutes // interval) * interval
+    if minutes % interval >= (interval + 1) // 2:
+        rounded_minutes += interval
+    return day_start + timedelta(minutes=rounded_minutes)
+
+
+def next_rounding_boundary(dt: datetime, interval: int = FIXED_INTERVAL) -> datetime:
+    # Момент, когда round_to_interval перейдет к следующему значению
+    return round_to_interval(dt, interval) + timedelta(minutes=(interval + 1) // 2)
+
+
+class UpdateScheduler:
+    def __init__(self, data: SharedData):
+        self.data = data
+
+    async def sleep_until(self, deadline: datetime) -> bool:
+        # Возвращает True, если сон прерван изменением данных через /set
+        timeout = (deadline - clock.now()).total_seconds()
         try:
-            now = datetime.now()
-            rounded_time = round_to_nearest_5_minutes(now)
-            last_update_time = await shared_data.get_last_time()
+            await clock.wait_event(self.data.changed, timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.data.changed.clear()
+        return True
+
+
+def build_frame_inputs(profile_text: str, weather_data: dict, moment: datetime,
+                       interval: int = FIXED_INTERVAL) -> Tuple[str, str, str, str]:
+    tz_offset = timedelta(seconds=weather_data['timezone'])
+    local_time = moment.astimezone(timezone(tz_offset))
+    rounded_local_time = round_to_interval(local_time, interval)
+    formatted_time = rounded_local_time.strftime("%H:%M")
+
+    temp = int(weather_data['main']['temp'])
+    weather_id = weather_data['weather'][0]['id']
+    weather_cond = translate_weather(weather_id, moment.time())
+
+    if temp > 0:
+        temp = f"+{temp}"
+    elif temp < 0:
+        temp = f"{temp}"
+    else:
+        temp = "0"
+
+    return (re.sub(r"[ -]{2,}", " ", profile_text), formatted_time, temp, weather_cond)
 
-            update_needed = False
-            if last_update_time is None:
-                update_needed = True
-            else:
-                # Проверяем, нужно ли обновление (если текущее округленное время больше последнего обновления)
-                if rounded_time > round_to_nearest_5_minutes(last_update_time):
-                    update_needed = True
 
-            if update_needed:
-                city_name, profile_text, lat, lon = await shared_data.get()
+def frame_fingerprint(inputs: Tuple[str, str, str, str]) -> str:
+    return hashlib.sha256("\0".join(inputs).encode()).hexdigest()
 
-                if None in (city_name, profile_text, lat, lon):
-                    logger.info("Данные для аватара не установлены. Пропуск.")
+
+class FramePrefetcher:
+    def __init__(self):
+        self.inputs: Optional[Tuple[str, str, str, str]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def schedule(self, inputs: Tuple[str, str, str, str]):
+        if self.task is not None and self.inputs == inputs:
+            return
+        if self.task is not None:
+            self.task.cancel()
+        self.inputs = inputs
+        self.task = asyncio.create_task(render_pool.render(*inputs))
+        logger.info(f"Предварительный рендер кадра {inputs[1]}")
+
+    def discard(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.task, self.inputs = None, None
+
+    async def take(self, inputs: Tuple[str, str, str, str]) -> Optional[Tuple[bytes, str]]:
+        task, prepared = self.task, self.inputs
+        self.task, self.inputs = None, None
+        if task is None:
+            return None
+        if prepared != inputs:
+            task.cancel()
+            logger.info("Погода изменилась, кадр будет отрисован заново")
+            return None
+        try:
+            return await task
+        except Exception as e:
+            logger.warning(f"Предварительный рендер не удался: {e}")
+            return None
+
+
+FORECAST_HOURS = int(os.getenv("FORECAST_HOURS", "0"))  # 0 — пакетный рендер по прогнозу выключен
+FORECAST_REFRESH = int(os.getenv("FORECAST_REFRESH", "3600"))  # Секунд между пакетными прогонами
+FRAME_CACHE_DIR = os.getenv("FRAME_CACHE_DIR", "frames")
+FRAME_CACHE_MAX_FILES = int(os.getenv("FRAME_CACHE_MAX_FILES", "2000"))
+FORECAST_WORKERS = int(os.getenv("FORECAST_WORKERS", "1"))
+
+
+class FrameCache:
+    FILE_NAMES = tuple(sorted({file_name for _, file_name in ENCODERS.values()}))
+
+    def __init__(self, directory: str, max_files: int):
+        self.directory = directory
+        self.max_files = max_files
+        self.settings: Optional[str] = None
+
+    def key(self, inputs: Tuple[str, str, str, str]) -> str:
+        # Кроме входных данных кадра в ключ входят настройки кодирования, разрешение и ассеты,
+        # чтобы после их смены не отдавать старые кадры
+        if self.settings is None:
+            self.settings = "\0".join(map(str, (AVATAR_ENCODER, PNG_COMPRESS_LEVEL, JPEG_QUALITY, AUTO_MAX_DIFFERENCE,
+                                                I["TEMPLATE"].width, assets_hash())))
+        return hashlib.sha256("\0".join(inputs + (self.settings,)).encode()).hexdigest()
+
+    def paths(self, inputs: Tuple[str, str, str, str]) -> list[Tuple[str, str]]:
+        key = self.key(inputs)
+        return [(os.path.join(self.directory, f"{key}-{file_name}"), file_name) for file_name in self.FILE_NAMES]
+
+    def has(self, inputs: Tuple[str, str, str, str]) -> bool:
+        return any(os.path.exists(path) for path, _ in self.paths(inputs))
+
+    def get(self, inputs: Tuple[str, str, str, str]) -> Optional[Tuple[bytes, str]]:
+        for path, file_name in self.paths(inputs):
+            try:
+                with open(path, "rb") as f:
+                    return f.read(), file_name
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Не удалось прочитать кадр {path}: {e}")
+        return None
+
+    def put(self, inputs: Tuple[str, str, str, str], data: bytes, file_name: str):
+        path = os.path.join(self.directory, f"{self.key(inputs)}-{file_name}")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кадр {path}: {e}")
+
+    def prune(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.is_file() and not entry.name.endswith(".tmp")]
+        except FileNotFoundError:
+            return
+        if len(entries) <= self.max_files:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_files]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+frame_cache = FrameCache(FRAME_CACHE_DIR, FRAME_CACHE_MAX_FILES)
+# Пакетный рендер идет в отдельном пуле процессов и не занимает очередь кадров текущих тиков
+forecast_pool = RenderPool("process", FORECAST_WORKERS, metric_prefix="batch_")
+
+
+def plan_forecast_frames(profile_text: str, current: dict, forecast: dict, start: datetime,
+                         hours: int, interval: int = FIXED_INTERVAL) -> list[Tuple[str, str, str, str]]:
+    # До первой точки прогноза действует текущая погода, дальше — последняя наступившая точка
+    tz_offset = forecast.get('city', {}).get('timezone', current['timezone'])
+    entries = sorted(forecast.get('list', []), key=lambda entry: entry['dt'])
+    frames: Dict[Tuple[str, str, str, str], None] = {}
+
+    slot = round_to_interval(start, interval)
+    end = start + timedelta(hours=hours)
+    while slot <= end:
+        weather = current
+        for entry in entries:
+            if entry['dt'] > slot.timestamp():
+                break
+            weather = {'timezone': tz_offset, 'main': entry['main'], 'weather': entry['weather']}
+        frames[build_frame_inputs(profile_text, weather, slot, interval)] = None
+        slot += timedelta(minutes=interval)
+    return list(frames)
+
+
+class ForecastBatcher:
+    def __init__(self, profile_name: str):
+        self.profile_name = profile_name
+        self.task: Optional[asyncio.Task] = None
+        self.plan: Optional[tuple] = None
+        self.planned_at: Optional[datetime] = None
+
+    def schedule(self, profile_text: str, lat: float, lon: float, interval: int, current: dict):
+        # Новый прогон — по таймеру или когда текущая погода разошлась с прошлым планом;
+        # уже готовые кадры находятся в кэше, так что перерисовываются только затронутые
+        plan = (profile_text, lat, lon, interval, int(current['main']['temp']), current['weather'][0]['id'])
+        if self.task is not None and not self.task.done():
+            return
+        if plan == self.plan and clock.now() < self.planned_at + timedelta(seconds=FORECAST_REFRESH):
+            return
+        self.plan, self.planned_at = plan, clock.now()
+        self.task = asyncio.create_task(self.run(profile_text, lat, lon, interval, current))
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+
+    async def run(self, profile_text: str, lat: float, lon: float, interval: int, current: dict):
+        try:
+            forecast = await weather_coordinator.forecast(lat, lon)
+            if not forecast:
+                logger.warning("Не удалось получить прогноз погоды, пакетный рендер отложен")
+                self.plan = None
+                return
+
+            planned = plan_forecast_frames(profile_text, current, forecast, clock.now(), FORECAST_HOURS, interval)
+            missing = await asyncio.to_thread(lambda: [inputs for inputs in planned if not frame_cache.has(inputs)])
+            started = perf_counter()
+            rendered = 0
+            # Порциями по числу воркеров, чтобы при отмене пакета в пуле не оставались сотни заданий
+            step = max(forecast_pool.workers, 1)
+            for start in range(0, len(missing), step):
+                chunk = missing[start:start + step]
+                results = await asyncio.gather(*(forecast_pool.render(*inputs) for inputs in chunk),
+                                               return_exceptions=True)
+                for inputs, result in zip(chunk, results):
+                    if isinstance(result, Exception):
+                        logger.warning(f"Пакетный рендер кадра {inputs[1]} не удался: {result}")
+                        continue
+                    await asyncio.to_thread(frame_cache.put, inputs, *result)
+                    rendered += 1
+
+            await asyncio.to_thread(frame_cache.prune)
+            metrics.inc("batch_frames", rendered, profile=self.profile_name)
+            logger.info(f"Пакетный рендер на {FORECAST_HOURS} ч: {rendered} новых кадров из {len(planned)} "
+                        f"за {perf_counter() - started:.1f} с ({self.profile_name})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.plan = None
+            logger.error(f"Ошибка пакетного рендера: {e}", exc_info=True)
+
+
+GALLERY_BATCH_SIZE = int(os.getenv("GALLERY_BATCH_SIZE", "10"))
+GALLERY_REBUILD_ON_START = os.getenv("GALLERY_REBUILD_ON_START", "1") == "1"
+
+
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(128 * 1024)))
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", "4"))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "3"))
+UPLOAD_HANDLE_TTL = int(os.getenv("UPLOAD_HANDLE_TTL", "3600"))  # Сколько секунд переиспользуем уже загруженный файл
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Больше этого Telegram требует SaveBigFilePart
+
+
+class ChunkedUploader:
+    MAX_PART_SIZE = 512 * 1024
+    MAX_ENTRIES = 32
+
+    def __init__(self, client: TelegramClient, part_size: int, parallelism: int, retries: int, handle_ttl: int):
+        # Telegram принимает части, кратные 1 КБ, на которые без остатка делится 512 КБ
+        if part_size <= 0 or part_size % 1024 or self.MAX_PART_SIZE % part_size:
+            logger.warning(f"Недопустимый размер части {part_size}, используется 128 КБ")
+            part_size = 128 * 1024
+        self.client = client
+        self.part_size = part_size
+        self.semaphore = asyncio.Semaphore(max(parallelism, 1))
+        self.retries = max(retries, 1)
+        self.handle_ttl = timedelta(seconds=handle_ttl)
+        # sha256 содержимого -> (file_id, номера уже принятых частей) для дозагрузки после сбоя
+        self.partial: OrderedDict[str, Tuple[int, set[int]]] = OrderedDict()
+        # sha256 содержимого -> (срок годности, InputFile) для повторного использования без загрузки
+        self.handles: OrderedDict[str, Tuple[datetime, Any]] = OrderedDict()
+
+    @staticmethod
+    def remember(entries: OrderedDict, key: str, value, limit: int):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > limit:
+            entries.popitem(last=False)
+
+    async def upload(self, data: bytes, file_name: str):
+        digest = hashlib.sha256(data).hexdigest()
+        handle = self.handles.get(digest)
+        if handle is not None:
+            expires, uploaded = handle
+            if clock.now() < expires:
+                metrics.inc("upload_handles_reused")
+                logger.info("Такой файл уже загружен, повторная загрузка не нужна")
+                return uploaded
+            del self.handles[digest]
+
+        is_big = len(data) > BIG_FILE_SIZE
+        part_count = max((len(data) + self.part_size - 1) // self.part_size, 1)
+        file_id, done = self.partial.get(digest) or (random.getrandbits(63), set())
+        self.remember(self.partial, digest, (file_id, done), self.MAX_ENTRIES)
+
+        async def send_part(index: int):
+            async with self.semaphore:
+                part = data[index * self.part_size:(index + 1) * self.part_size]
+                if is_big:
+                    request = SaveBigFilePartRequest(file_id, index, part_count, part)
                 else:
-                    if len(to_delete) == 10:
-                        await client(DeletePhotosRequest(id=to_delete))
-                        to_delete.clear()
-                        logger.info("Очистка галереи профиля")
+                    request = SaveFilePartRequest(file_id, index, part)
+                if not await self.client(request):
+                    raise ConnectionError(f"Telegram не принял часть {index} из {part_count}")
+                done.add(index)
+
+        for attempt in range(1, self.retries + 1):
+            missing = [index for index in range(part_count) if index not in done]
+            if done:
+                metrics.inc("upload_parts_resumed", part_count - len(missing))
+                logger.info(f"Дозагрузка файла: осталось {len(missing)} из {part_count} частей")
+            results = await asyncio.gather(*(send_part(index) for index in missing), return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            if not errors:
+                break
+            # FloodWait и прочие ошибки, кроме сетевых, обрабатывает вызывающий код; принятые части сохраняются
+            retryable = all(isinstance(error, (ConnectionError, asyncio.TimeoutError)) for error in errors)
+            if not retryable or attempt == self.retries:
+                raise errors[0]
+            logger.warning(f"Не удалось загрузить {len(errors)} из {len(missing)} частей (попытка {attempt}): {errors[0]}")
+
+        del self.partial[digest]
+        if is_big:
+            uploaded = InputFileBig(file_id, part_count, file_name)
+        else:
+            uploaded = InputFile(file_id, part_count, file_name, hashlib.md5(data).hexdigest())
+        self.remember(self.handles, digest, (clock.now() + self.handle_ttl, uploaded), self.MAX_ENTRIES)
+        return uploaded
 
-                    async with aiohttp.ClientSession() as session:
-                        weather_data = await get_weather_data(session, lat, lon)
-                        if weather_data:
-                            tz_offset = timedelta(seconds=weather_data['timezone'])
-                            local_time = datetime.now(timezone(tz_offset))
-                            rounded_local_time = round_to_nearest_5_minutes(local_time)
-                            formatted_time = rounded_local_time.strftime("%H:%M")
-                            
-                            temp = int(weather_data['main']['temp'])
-                            weather_id = weather_data['weather'][0]['id']
-                            weather_cond = translate_weather(
-                                weather_id,
-                                datetime.now().time()
-                            )
-
-                            if temp > 0:
-                                temp = f"+{temp}"
-                            elif temp < 0:
-                                temp = f"{temp}"
-                            else:
-                                temp = "0"
+    def forget(self, uploaded):
+        # Telegram отверг загруженный файл (например, части истекли) — больше его не предлагаем
+        for digest, (_, handle) in list(self.handles.items()):
+            if handle is uploaded:
+                del self.handles[digest]
 
-                            icon = generate_icon(
-                                re.sub(r"[ -]{2,}", " ", profile_text),
-                                formatted_time,
-                                temp,
-                                weather_cond
-                            )
 
-                            with io.BytesIO() as buffer:
-                                icon.save(buffer, format='PNG')
-                                buffer.seek(0)
+class TelethonBackend:
+    def __init__(self, session_name: str):
+        self.client = TelegramClient(session_name, TELEGRAM_API_ID, TELEGRAM_API_HASH)
+        self.uploader = ChunkedUploader(self.client, UPLOAD_PART_SIZE, UPLOAD_PARALLELISM,
+                                        UPLOAD_RETRIES, UPLOAD_HANDLE_TTL)
 
-                                result = await client(UploadProfilePhotoRequest(file=await client.upload_file(buffer, file_name="icon.png")))
+    async def start(self):
+        await self.client.start()
 
-                                to_delete.append(InputPhoto(id=result.photo.id, access_hash=result.photo.access_hash,
-                                                            file_reference=result.photo.file_reference))
-                            logger.info(f"Аватар успешно обновлен (время: {formatted_time})")
-                            await shared_data.update_last_time() 
+    async def disconnect(self):
+        await self.client.disconnect()
+
+    async def upload_file(self, data: bytes, file_name: str):
+        return await self.uploader.upload(data, file_name)
+
+    async def upload_profile_photo(self, uploaded):
+        try:
+            result = await self.client(UploadProfilePhotoRequest(file=uploaded))
+        except FloodWaitError:
+            raise
+        except Exception:
+            self.uploader.forget(uploaded)
+            raise
+        return result.photo
+
+    async def delete_photos(self, photos: list[InputPhoto]):
+        await self.client(DeletePhotosRequest(id=photos))
+
+    async def get_photos(self) -> list:
+        photos = []
+        while True:
+            result = await self.client(GetUserPhotosRequest(
+                user_id=InputUserSelf(), offset=len(photos), max_id=0, limit=100))
+            photos.extend(result.photos)
+            if not result.photos or len(photos) >= getattr(result, 'count', len(photos)):
+                return photos
+
+
+class FakeTelegramBackend:
+    def __init__(self, faults: FaultInjector):
+        self.faults = faults
+        self.photos: list[InputPhoto] = []
+        self.next_id = 1
+
+    async def start(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def upload_file(self, data: bytes, file_name: str):
+        await self.faults()
+        return (file_name, len(data))
+
+    async def upload_profile_photo(self, uploaded):
+        await self.faults()
+        photo = InputPhoto(id=self.next_id, access_hash=random.getrandbits(63), file_reference=b"")
+        self.next_id += 1
+        self.photos.insert(0, photo)
+        return photo
+
+    async def delete_photos(self, photos: list[InputPhoto]):
+        await self.faults()
+        deleted = {photo.id for photo in photos}
+        self.photos = [photo for photo in self.photos if photo.id not in deleted]
+
+    async def get_photos(self) -> list:
+        await self.faults()
+        return list(self.photos)
+
+
+def create_telegram_backend(profile: "Profile"):
+    if BACKENDS == "fake":
+        return FakeTelegramBackend(FaultInjector(FAKE_LATENCY, FAKE_FAILURE_RATE, FAKE_FLOOD_RATE, FAKE_FLOOD_SECONDS))
+    return TelethonBackend(profile.session_name)
+
+
+def to_input_photo(photo) -> InputPhoto:
+    return InputPhoto(id=photo.id, access_hash=photo.access_hash, file_reference=photo.file_reference)
+
+
+class GalleryCleaner:
+    def __init__(self, backend, data: SharedData, batch_size: int, profile_name: str):
+        self.backend = backend
+        self.data = data
+        self.profile_name = profile_name
+        self.batch_size = batch_size
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def add(self, photo: InputPhoto):
+        # Текущий аватар не удаляем, в очередь попадает предыдущий
+        if self.data.gallery_current is not None:
+            self.data.gallery_pending.append(self.data.gallery_current)
+        self.data.gallery_current = photo
+        self.data.mark_dirty()
+        if len(self.data.gallery_pending) >= self.batch_size:
+            self.wake.set()
+
+    async def rebuild(self):
+        # Сверяем с галереей только фото, которые загрузил бот: снимки, поставленные вручную, не трогаем.
+        # Уже удаленные выпадают из очереди, у оставшихся обновляется file_reference
+        photos = {photo.id: to_input_photo(photo) for photo in await self.backend.get_photos()}
+        current = self.data.gallery_current
+        self.data.gallery_current = photos.get(current.id) if current is not None else None
+        self.data.gallery_pending = [photos[photo.id] for photo in self.data.gallery_pending if photo.id in photos]
+        self.data.mark_dirty()
+        logger.info(f"Галерея профиля: {len(photos)} фото, к удалению {len(self.data.gallery_pending)} "
+                    f"из загруженных ботом")
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        if len(self.data.gallery_pending) >= self.batch_size:
+            self.wake.set()
+
+        while self.data.is_running():
+            await self.wake.wait()
+            self.wake.clear()
+
+            while len(self.data.gallery_pending) >= self.batch_size:
+                _, flood_until = await self.data.get_flood_info()
+                now = clock.now()
+                if flood_until and now < flood_until:
+                    await clock.sleep((flood_until - now).total_seconds())
+                    continue
+
+                batch = self.data.gallery_pending[:100]
+                try:
+                    with metrics.span("gallery_cleanup", profile=self.profile_name):
+                        await self.backend.delete_photos(batch)
+                except FloodWaitError as e:
+                    metrics.inc("flood_waits", profile=self.profile_name)
+                    logger.warning(f"Очистка галереи отложена на {e.seconds} секунд")
+                    await self.data.set_flood_wait(e.seconds + 1)
+                    continue
+                except Exception as e:
+                    metrics.inc("errors", profile=self.profile_name)
+                    logger.error(f"Ошибка очистки галереи: {e}")
+                    break
+                del self.data.gallery_pending[:len(batch)]
+                self.data.mark_dirty()
+                logger.info(f"Очистка галереи профиля ({len(batch)} фото)")
+
+
+PRERENDER_LEAD = int(os.getenv("PRERENDER_LEAD", "60"))
+
+
+async def run_telethon(profile: Profile):
+    backend = create_telegram_backend(profile)
+    await backend.start()
+    logger.info(f"Автосмена аватара запущена ({profile.name})")
+    cleaner = GalleryCleaner(backend, profile.data, GALLERY_BATCH_SIZE, profile.name)
+    if GALLERY_REBUILD_ON_START:
+        # Сверка до первой загрузки: фото, загруженное во время запроса списка, не попало бы в него
+        # и выпало бы из учета
+        try:
+            await cleaner.rebuild()
+        except Exception as e:
+            logger.error(f"Не удалось получить список фото профиля: {e}")
+    cleaner.start()
+    prefetcher = FramePrefetcher()
+    batcher = ForecastBatcher(profile.name) if FORECAST_HOURS > 0 else None
+    scheduler = UpdateScheduler(profile.data)
+    last_weather: Optional[dict] = None
+    force_update = False
+
+    while profile.data.is_running():
+        wake_at = None
+        try:
+            now = clock.now()
+            _, flood_until = await profile.data.get_flood_info()
+
+            if flood_until and now < flood_until:
+                logger.info(f"Обновление отложено до {flood_until:%H:%M:%S} из-за ограничений Telegram")
+                wake_at = flood_until
+            else:
+                target = now + timedelta(seconds=SCHEDULER_LEAD)
+                interval = await profile.data.get_effective_interval()
+                last_update_time = await profile.data.get_last_time()
+
+                update_needed = force_update
+                if last_update_time is None:
+                    update_needed = True
+                else:
+                    # Проверяем, нужно ли обновление (если текущее округленное время больше последнего обновления)
+                    if round_to_interval(target, interval) > round_to_interval(last_update_time, interval):
+                        update_needed = True
+
+                city_name, profile_text, lat, lon = await profile.data.get()
+                data_ready = None not in (city_name, profile_text, lat, lon)
+                remaining_uploads, next_upload_slot = await profile.data.get_upload_budget()
+
+                if update_needed:
+                    if not data_ready:
+                        logger.info("Данные для аватара не установлены. Пропуск.")
+                    elif remaining_uploads == 0:
+                        logger.warning(f"Часовой лимит загрузок исчерпан, следующая не раньше {next_upload_slot:%H:%M:%S}")
+                        wake_at = next_upload_slot
+                    else:
+                        with metrics.span("weather_fetch", profile=profile.name):
+                            weather_data = await get_weather_data(lat, lon)
+                        if weather_data:
+                            last_weather = weather_data
+                            if batcher is not None:
+                                batcher.schedule(profile_text, lat, lon, interval, weather_data)
+                            inputs = build_frame_inputs(profile_text, weather_data, target, interval)
+                            inputs_fingerprint = frame_fingerprint(inputs)
+
+                            if await profile.data.is_duplicate_frame(inputs_fingerprint):
+                                prefetcher.discard()
+                                frame = None
+                            else:
+                                frame = None
+                                if batcher is not None:
+                                    frame = await asyncio.to_thread(frame_cache.get, inputs)
+                                    metrics.inc("frame_cache_hits" if frame else "frame_cache_misses",
+                                                profile=profile.name)
+                                if frame is None:
+                                    frame = await prefetcher.take(inputs)
+                                    if frame is None:
+                                        frame = await render_pool.render(*inputs)
+                                    if batcher is not None:
+                                        await asyncio.to_thread(frame_cache.put, inputs, *frame)
+                                else:
+                                    prefetcher.discard()
+                                pixels_fingerprint = hashlib.sha256(frame[0]).hexdigest()
+                                if await profile.data.is_duplicate_frame(inputs_fingerprint, pixels_fingerprint):
+                                    frame = None
+
+                            if frame is None:
+                                await profile.data.count_skipped_upload()
+                                metrics.inc("skipped_frames", profile=profile.name)
+                                logger.info(f"Кадр не изменился, загрузка пропущена (время: {inputs[1]})")
+                            else:
+                                icon_data, file_name = frame
+                                with metrics.span("upload_file", profile=profile.name):
+                                    uploaded = await backend.upload_file(icon_data, file_name)
+                                with metrics.span("upload_profile_photo", profile=profile.name):
+                                    photo = await backend.upload_profile_photo(uploaded)
+
+                                cleaner.add(to_input_photo(photo))
+                                await profile.data.record_upload()
+                                await profile.data.set_frame_fingerprint(inputs_fingerprint, pixels_fingerprint)
+                                # Задержка от момента, когда округленное время сменилось, до появления аватара;
+                                # в реальных секундах, как и остальные этапы, в том числе при ускоренном времени
+                                boundary = round_to_interval(target, interval) - timedelta(minutes=interval // 2)
+                                lag = (clock.now() - boundary).total_seconds() / clock.factor
+                                metrics.observe("boundary_to_visible", max(lag, 0.0), profile=profile.name)
+                                metrics.inc("uploads", profile=profile.name)
+                                logger.info(f"Аватар успешно обновлен (время: {inputs[1]}, "
+                                            f"загружено {len(icon_data) / 1024:.0f} КБ)")
+                            await profile.data.update_last_time(target)
+                            force_update = False
                         else:
                             logger.warning("Не удалось получить данные о погоде")
-
-            await asyncio.sleep(10)
+                            wake_at = clock.now() + timedelta(seconds=10)
+
+                if wake_at is None:
+                    boundary = next_rounding_boundary(target, interval)
+                    wake_at = boundary - timedelta(seconds=SCHEDULER_LEAD)
+                    if last_weather and data_ready:
+                        prerender_at = wake_at - timedelta(seconds=PRERENDER_LEAD)
+                        if clock.now() >= prerender_at:
+                            next_inputs = build_frame_inputs(profile_text, last_weather, boundary, interval)
+                            if batcher is None or not await asyncio.to_thread(frame_cache.has, next_inputs):
+                                prefetcher.schedule(next_inputs)
+                        else:
+                            wake_at = prerender_at
 
         except FloodWaitError as e:
             wait_seconds = e.seconds
+            metrics.inc("flood_waits", profile=profile.name)
             logger.warning(f"Ожидание {wait_seconds} секунд из-за ограничений Telegram")
-            await shared_data.set_flood_wait(wait_seconds)
-            await asyncio.sleep(wait_seconds + 1)
+            await profile.data.set_flood_wait(wait_seconds + 1)
+            continue
         except Exception as e:
+            metrics.inc("errors", profile=profile.name)
             logger.error(f"Ошибка в Telethon: {e}", exc_info=True)
-            await asyncio.sleep(10)
+            wake_at = clock.now() + timedelta(seconds=10)
+
+        if await scheduler.sleep_until(wake_at):
+            force_update = True
 
-    await client.disconnect()
-    logger.info("Telethon клиент остановлен")
+    if batcher is not None:
+        batcher.cancel()
+    await cleaner.stop()
+    await backend.disconnect()
+    logger.info(f"Telethon клиент остановлен ({profile.name})")
 
 
 async def run_bot():
@@ -719,11 +2632,39 @@ async def run_bot():
     await dp.start_polling(bot)
 
 
+async def warm_clock_atlas():
+    try:
+        await asyncio.to_thread(clock_atlas.warm)
+    except Exception as e:
+        logger.error(f"Не удалось прогреть атлас циферблатов: {e}", exc_info=True)
+
+
 async def main():
+    for profile in profiles.values():
+        state_store.load(profile)
+
+    if CLOCK_ATLAS_PREWARM and RENDER_BACKEND != "process":
+        task = asyncio.create_task(warm_clock_atlas())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    render_pool.start()
+    get_http_session()
+    metrics_runner = await start_metrics_server()
+
     bot_task = asyncio.create_task(run_bot())
-    telethon_task = asyncio.create_task(run_telethon())
+    telethon_tasks = [asyncio.create_task(run_telethon(profile)) for profile in profiles.values()]
 
-    await asyncio.gather(bot_task, telethon_task)
+    try:
+        await asyncio.gather(bot_task, *telethon_tasks)
+    finally:
+        await state_store.flush()
+        render_pool.shutdown()
+        forecast_pool.shutdown()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if http_session is not None:
+            await http_session.close()
 
 
 if __name__ == '__main__':
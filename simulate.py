@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+from time import perf_counter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочная симуляция цикла обновления на локальных заглушках")
+    parser.add_argument("--profiles", type=int, default=10, help="число симулируемых аккаунтов")
+    parser.add_argument("--cities", type=int, default=3, help="число разных городов среди аккаунтов")
+    parser.add_argument("--hours", type=float, default=24, help="длительность в модельных часах")
+    parser.add_argument("--acceleration", type=float, default=720, help="во сколько раз модельное время быстрее реального")
+    parser.add_argument("--latency", type=float, default=0.3, help="задержка заглушек, модельные секунды")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="доля запросов, завершающихся сбоем")
+    parser.add_argument("--flood-rate", type=float, default=0.005, help="доля запросов Telegram с FloodWaitError")
+    parser.add_argument("--flood-seconds", type=int, default=300, help="длительность flood-wait, модельные секунды")
+    parser.add_argument("--output", help="куда сохранить JSON с результатами")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Конфигурация main.py читается при импорте, поэтому окружение задаем заранее
+os.environ.update({
+    'BACKENDS': 'fake',
+    'TIME_ACCELERATION': str(args.acceleration),
+    'FAKE_LATENCY': str(args.latency),
+    'FAKE_FAILURE_RATE': str(args.failure_rate),
+    'FAKE_FLOOD_RATE': str(args.flood_rate),
+    'FAKE_FLOOD_SECONDS': str(args.flood_seconds),
+    'METRICS_PORT': '0',
+})
+os.environ.pop('ACCOUNTS_FILE', None)
+os.environ.setdefault('BOT_API_KEY', '123456:simulation')
+os.environ.setdefault('USER_ID', '0')
+os.environ.setdefault('TELEGRAM_API_ID', '0')
+os.environ.setdefault('TELEGRAM_API_HASH', 'simulation')
+
+from main import (Profile, profiles, metrics, clock, render_pool, forecast_pool, run_telethon, render_frame,
+                  init_render_worker, FIXED_INTERVAL, RENDER_WORKERS)
+
+
+def create_profiles():
+    profiles.clear()
+    for index in range(args.profiles):
+        profile = Profile(f"sim{index}", f"sim{index}", index + 1)
+        city = index % args.cities
+        profile.data.city_name = f"Город {city}"
+        profile.data.profile_text = f"Профиль {index} из города {city}"
+        profile.data.lat = 50.0 + city
+        profile.data.lon = 30.0 + city
+        profiles[profile.owner_id] = profile
+
+
+def check_acceleration() -> list[str]:
+    # Рендер идет в реальном времени: при большом ускорении один кадр занимает модельные минуты,
+    # и симуляция начинает пропускать границы интервалов, которых в жизни не пропустила бы
+    init_render_worker()
+    render_frame("Проба", "12:00", "+1", "SUN")
+    started = perf_counter()
+    render_frame("Проба", "12:05", "+2", "CLOUD")
+    frame_seconds = perf_counter() - started
+
+    rounds = -(-args.profiles // max(RENDER_WORKERS, 1))
+    simulated = frame_seconds * rounds * args.acceleration
+    if simulated <= FIXED_INTERVAL * 60:
+        return []
+    safe = FIXED_INTERVAL * 60 / (frame_seconds * rounds)
+    return [f"рендер {args.profiles} кадр(ов) занимает {frame_seconds * rounds:.2f} реальных с, "
+            f"то есть {simulated:.0f} модельных с — больше интервала {FIXED_INTERVAL} мин; "
+            f"задержки и пропуски будут завышены, ускорение стоит снизить до {safe:.0f}"]
+
+
+async def simulate() -> dict:
+    create_profiles()
+    warnings = check_acceleration()
+    for warning in warnings:
+        print(f"Внимание: {warning}", file=sys.stderr)
+    render_pool.start()
+
+    sim_started = clock.now()
+    real_started = perf_counter()
+    tasks = [asyncio.create_task(run_telethon(profile)) for profile in profiles.values()]
+
+    await clock.sleep(args.hours * 3600)
+    for profile in profiles.values():
+        await profile.data.stop()
+    await asyncio.wait(tasks, timeout=30)
+
+    real_seconds = perf_counter() - real_started
+    sim_hours = (clock.now() - sim_started).total_seconds() / 3600
+    render_pool.shutdown()
+    forecast_pool.shutdown()
+
+    def total(name: str) -> int:
+        return int(sum(metrics.value(name, profile=profile.name) for profile in profiles.values()))
+
+    uploads = total("uploads")
+    return {
+        "profiles": args.profiles,
+        "cities": args.cities,
+        "simulated_hours": round(sim_hours, 2),
+        "real_seconds": round(real_seconds, 2),
+        "uploads": uploads,
+        "skipped_frames": total("skipped_frames"),
+        "flood_waits": total("flood_waits"),
+        "errors": total("errors"),
+        "weather_cache_misses": int(metrics.value("weather_cache_misses")),
+        "weather_cache_hits": int(metrics.value("weather_cache_hits")),
+        "uploads_per_real_second": round(uploads / real_seconds, 2) if real_seconds else 0,
+        "render": render_pool.stats.summary(),
+        "warnings": warnings,
+        "phases": {profile.name: metrics.summary(profile=profile.name) for profile in profiles.values()},
+    }
+
+
+if __name__ == '__main__':
+    results = asyncio.run(simulate())
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)